@@ -3,22 +3,636 @@ import os
 from botocore.client import ClientError
 import logging
 from decimal import Decimal
+import csv
+import json
 import logging
 import os
+import queue
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import boto3
 from boto3.dynamodb.conditions import Key
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
+try:
+	import numpy as np
+except ImportError:
+	np = None
+try:
+	import pyarrow as pa
+	import pyarrow.csv as pa_csv
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
 
 
 logger = logging.getLogger(__name__)
 
-class Dynamo(boto3.resource):
+# batch_write_item accepts at most 25 requests and batch_get_item 100 keys
+WRITE_BATCH_SIZE = 25
+GET_BATCH_SIZE = 100
+# cached marker for items known to be missing
+MISSING = object()
+
+def backoff_delay(retries,base_delay=0.05,max_delay=5):
+	'''
+	Full jitter exponential backoff
+	'''
+	return random.uniform(0,min(max_delay,base_delay * 2 ** retries))
+
+class ItemCache():
+	'''
+	Thread safe LRU cache of items with a TTL
+	Missing items are cached as MISSING for negative_ttl seconds (defaults to ttl), 0 disables negative caching.
+	Cached items are shared, callers must not mutate them.
+	'''
+	def __init__(self,max_items=10000,ttl=60,negative_ttl=None):
+		self.max_items = max_items
+		self.ttl = ttl
+		self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+		self.items = OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+	def get(self,key):
+		'''
+		Cached item, MISSING or None when not cached
+		'''
+		with self.lock:
+			entry = self.items.get(key)
+			if entry is not None and entry[1] > time.monotonic():
+				self.items.move_to_end(key)
+				self.hits += 1
+				return entry[0]
+			if entry is not None:
+				del self.items[key]
+			self.misses += 1
+			return None
+	def set(self,key,item):
+		ttl = self.negative_ttl if item is MISSING else self.ttl
+		if ttl <= 0:
+			return
+		with self.lock:
+			self.items[key] = (item,time.monotonic() + ttl)
+			self.items.move_to_end(key)
+			while len(self.items) > self.max_items:
+				self.items.popitem(last=False)
+	def invalidate(self,key=None):
+		with self.lock:
+			if key is None:
+				self.items.clear()
+			else:
+				self.items.pop(key,None)
+	def stats(self):
+		with self.lock:
+			lookups = self.hits + self.misses
+			return {
+				'hits':self.hits,
+				'misses':self.misses,
+				'hit_rate':self.hits / lookups if lookups else 0.0,
+				'items':len(self.items),
+			}
+
+class CapacityThrottle():
+	'''
+	Token bucket of capacity units per second shared by worker threads
+	Requests wait while the bucket is in debt and the ConsumedCapacity of each response is charged afterwards,
+	so throughput converges on units_per_second without knowing item sizes in advance.
+	'''
+	def __init__(self,units_per_second):
+		self.units_per_second = units_per_second
+		self.allowance = units_per_second
+		self.last_check = time.monotonic()
+		self.consumed = 0.0
+		self.lock = threading.Lock()
+	def _refill(self):
+		now = time.monotonic()
+		self.allowance = min(self.units_per_second,self.allowance + (now - self.last_check) * self.units_per_second)
+		self.last_check = now
+	def wait(self):
+		while True:
+			with self.lock:
+				self._refill()
+				if self.allowance > 0:
+					return
+				delay = -self.allowance / self.units_per_second
+			time.sleep(delay)
+	def consume(self,response):
+		'''
+		Charge the capacity reported by a response made with ReturnConsumedCapacity
+		'''
+		capacity = response.get('ConsumedCapacity',{})
+		if isinstance(capacity,list):
+			units = sum(c.get('CapacityUnits',0) for c in capacity)
+		else:
+			units = capacity.get('CapacityUnits',0)
+		with self.lock:
+			self._refill()
+			self.allowance -= units
+			self.consumed += units
+		return units
+
+def stream_tasks(tasks,max_workers,max_buffered=1000):
+	'''
+	Run generator functions on max_workers threads and yield their items as they are produced
+	At most max_buffered items are held, an exception in a task is raised in the consumer
+	and closing the generator stops the workers.
+	'''
+	results = queue.Queue(maxsize=max_buffered)
+	stop = threading.Event()
+	done = object()
+
+	def put(item):
+		while not stop.is_set():
+			try:
+				results.put(item,timeout=0.1)
+				return True
+			except queue.Full:
+				continue
+		return False
+
+	def run(task):
+		try:
+			for item in task():
+				if not put(item):
+					return
+		except Exception as e:
+			put(e)
+		finally:
+			put(done)
+
+	tasks = list(tasks)
+	executor = ThreadPoolExecutor(max_workers=max_workers)
+	for task in tasks:
+		executor.submit(run,task)
+	try:
+		remaining = len(tasks)
+		while remaining:
+			item = results.get()
+			if item is done:
+				remaining -= 1
+			elif isinstance(item,Exception):
+				raise item
+			else:
+				yield item
+	finally:
+		stop.set()
+		executor.shutdown(wait=True,cancel_futures=True)
+
+def numeric_column(values):
+	'''
+	Decimal/None values as an int64 array when every value is integral and present, otherwise float64 with NaN for None
+	Conversion runs in numpy's C loops instead of calling float or int per value from Python
+	'''
+	array = np.array(values,dtype=object)
+	missing = array == None  # noqa: E711 elementwise comparison
+	if missing.any():
+		array[missing] = np.nan
+	floats = array.astype(np.float64)
+	if not missing.any() and len(floats) and np.all(np.abs(floats) < 2 ** 53) and np.all(floats == np.floor(floats)):
+		return floats.astype(np.int64)
+	return floats
+
+def json_default(value):
+	if isinstance(value,(set,frozenset)):
+		return list(value)
+	if isinstance(value,Decimal):
+		return int(value) if value == value.to_integral_value() else float(value)
+	return str(value)
+
+def convert_column(values):
+	'''
+	numpy array for one column of DynamoDB values
+	Numbers become int64/float64, booleans bool, strings str and maps, lists and sets JSON strings,
+	a column without values stays None so Arrow types it as null
+	'''
+	kinds = {type(v) for v in values if v is not None}
+	if not kinds:
+		return np.array(values,dtype=object)
+	if kinds <= {Decimal,int,float}:
+		return numeric_column(values)
+	if kinds == {bool} and None not in values:
+		return np.array(values,dtype=bool)
+	if kinds == {str}:
+		return np.array(values,dtype=object)
+	return np.array([
+		v if v is None or isinstance(v,str) else json.dumps(v,default=json_default)
+		for v in values
+	],dtype=object)
+
+def widen_type(a,b):
+	'''
+	Arrow type holding values of both a and b: null gives way to anything, int to float and the rest to string
 	'''
-	DynamoDB.Client
+	if a == b or pa.types.is_null(b):
+		return a
+	if pa.types.is_null(a):
+		return b
+	if all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in (a,b)):
+		return pa.float64()
+	return pa.string()
+
+class ColumnarExporter():
+	'''
+	Stream items into per column buffers and write them as Parquet row groups or CSV chunks of chunk_size rows
+	Columns default to every attribute seen, dtypes {column: numpy dtype} overrides the inferred types.
+	Column types are widened when a later chunk needs it (see widen_type) and attributes first seen in a later chunk
+	are added as columns, null in the rows already written. Parquet row groups already written are then rewritten
+	with the wider schema, CSV rows get an empty field per added column.
+	Needs numpy, Parquet and Arrow CSV output need pyarrow (CSV falls back to the csv module)
+	'''
+	def __init__(self,path,format='parquet',columns=None,chunk_size=100000,dtypes=None):
+		if np is None:
+			raise ImportError('ColumnarExporter requires numpy')
+		if format not in ('parquet','csv'):
+			raise ValueError(f'unsupported format {format}')
+		if format == 'parquet' and pa is None:
+			raise ImportError('parquet export requires pyarrow')
+		self.path = path
+		self.format = format
+		self.columns = list(columns) if columns else None
+		self.all_columns = not columns
+		self.chunk_size = chunk_size
+		self.dtypes = dtypes or {}
+		self.buffers = {column:[] for column in self.columns or []}
+		self.rows = 0
+		self.buffered = 0
+		self.writer = None
+		self.file = None
+		self.schema = None
+	def add(self,item):
+		if self.all_columns:
+			for column in item:
+				if column not in self.buffers:
+					self.buffers[column] = [None] * self.buffered
+		for column,buffer in self.buffers.items():
+			buffer.append(item.get(column))
+		self.buffered += 1
+		if self.buffered >= self.chunk_size:
+			self.flush()
+	def write(self,items):
+		for item in items:
+			self.add(item)
+		return self
+	def arrays(self):
+		arrays = {}
+		for column,values in self.buffers.items():
+			array = convert_column(values)
+			if column in self.dtypes:
+				array = array.astype(self.dtypes[column])
+			arrays[column] = array
+		return arrays
+	def flush(self):
+		if not self.buffered:
+			return
+		if self.columns is None:
+			self.columns = []
+		late = [column for column in self.buffers if column not in self.columns]
+		if late and self.format == 'csv' and self.file is not None:
+			self._extend_csv(late)
+		self.columns += late
+		arrays = self.arrays()
+		if self.format == 'parquet':
+			self._write_parquet(arrays)
+		else:
+			self._write_csv(arrays)
+		self.rows += self.buffered
+		self.buffered = 0
+		self.buffers = {column:[] for column in self.columns}
+	def arrow_table(self,arrays):
+		# from_pandas maps NaN and None to nulls
+		return pa.table({column:pa.array(array,from_pandas=True) for column,array in arrays.items()})
+	def widen_schema(self,schema):
+		fields = [pa.field(field.name,widen_type(field.type,schema.field(field.name).type)) for field in self.schema]
+		return pa.schema(fields + [field for field in schema if field.name not in self.schema.names])
+	def _write_parquet(self,arrays):
+		table = self.arrow_table(arrays)
+		if self.writer is None:
+			self.schema = table.schema
+			self.writer = pq.ParquetWriter(self.path,self.schema)
+		else:
+			schema = self.widen_schema(table.schema)
+			if schema != self.schema:
+				self._rewrite_parquet(schema)
+		self.writer.write_table(table.cast(self.schema))
+	def _rewrite_parquet(self,schema):
+		'''
+		Copy the row groups written so far into a new file with schema, one row group at a time
+		'''
+		self.writer.close()
+		previous = f'{self.path}.previous'
+		os.replace(self.path,previous)
+		self.schema = schema
+		self.writer = pq.ParquetWriter(self.path,schema)
+		with pq.ParquetFile(previous) as source:
+			for i in range(source.num_row_groups):
+				table = source.read_row_group(i)
+				columns = {name:table.column(name) if name in table.column_names else pa.nulls(table.num_rows) for name in schema.names}
+				self.writer.write_table(pa.table(columns).cast(schema))
+		os.remove(previous)
+	def _extend_csv(self,late):
+		'''
+		Copy the CSV written so far into a new file with the late columns added, empty in every row
+		'''
+		if pa is not None:
+			self.writer.close()
+		self.file.close()
+		encoding = 'utf-8' if pa is not None else None
+		previous = f'{self.path}.previous'
+		os.replace(self.path,previous)
+		with open(previous,newline='',encoding=encoding) as source,open(self.path,'w',newline='',encoding=encoding) as target:
+			writer = csv.writer(target)
+			for i,row in enumerate(csv.reader(source)):
+				writer.writerow(row + (late if i == 0 else [''] * len(late)))
+		os.remove(previous)
+		if pa is not None:
+			self.file = open(self.path,'ab')
+			self.schema = pa.schema(list(self.schema) + [pa.field(column,pa.null()) for column in late])
+			self.writer = pa_csv.CSVWriter(self.file,self.schema,write_options=pa_csv.WriteOptions(include_header=False))
+		else:
+			self.file = open(self.path,'a',newline='')
+			self.writer = csv.writer(self.file)
+	def _write_csv(self,arrays):
+		if pa is not None:
+			table = self.arrow_table(arrays)
+			if self.writer is None:
+				self.file = open(self.path,'wb')
+				self.schema = table.schema
+				self.writer = pa_csv.CSVWriter(self.file,self.schema)
+			else:
+				schema = self.widen_schema(table.schema)
+				if schema != self.schema:
+					# rows already written are text, carry on under the wider schema without a second header
+					self.writer.close()
+					self.schema = schema
+					self.writer = pa_csv.CSVWriter(self.file,schema,write_options=pa_csv.WriteOptions(include_header=False))
+			self.writer.write_table(table.cast(self.schema))
+			return
+		if self.file is None:
+			self.file = open(self.path,'w',newline='')
+			self.writer = csv.writer(self.file)
+			self.writer.writerow(self.columns)
+		self.writer.writerows(zip(*(arrays[column].tolist() for column in self.columns)))
+	def close(self):
+		self.flush()
+		if self.writer is not None and hasattr(self.writer,'close'):
+			self.writer.close()
+		if self.file is not None:
+			self.file.close()
+	def __enter__(self):
+		return self
+	def __exit__(self,*exc):
+		self.close()
+
+def set_expression(values):
+	'''
+	update_item kwargs setting every attribute in values
+	'''
+	names = {}
+	attribute_values = {}
+	assignments = []
+	for i,(name,value) in enumerate(values.items()):
+		names[f'#a{i}'] = name
+		attribute_values[f':v{i}'] = value
+		assignments.append(f'#a{i} = :v{i}')
+	return {
+		'UpdateExpression':'SET ' + ', '.join(assignments),
+		'ExpressionAttributeNames':names,
+		'ExpressionAttributeValues':attribute_values,
+	}
+
+class WriteBuffer():
+	'''
+	Write-behind buffer coalescing puts, attribute updates and deletes of the same key
+	Puts and deletes are flushed with batch_write_item, updates (SET only) with one update_item per key.
+	A flush runs when max_items keys are pending, when the oldest pending write is max_delay seconds old,
+	on flush() and when used as a context manager on exit. Writes that fail are put back, merged under any newer
+	write of the same key. Reads through Dynamo do not see pending writes, cached items are invalidated once written.
+	'''
+	def __init__(self,dynamo,max_items=100,max_delay=1.0,max_retries=8):
+		self.dynamo = dynamo
+		self.max_items = max_items
+		self.max_delay = max_delay
+		self.max_retries = max_retries
+		self.key_names = dynamo.key_names()
+		self.pending = OrderedDict()
+		self.pending_since = None
+		self.lock = threading.Lock()
+		self.flush_lock = threading.Lock()
+		self.received = 0
+		self.sent = 0
+		self.flushes = 0
+		self.flush_seconds = 0.0
+		self.max_flush_seconds = 0.0
+		self.closed = threading.Event()
+		self.timer = threading.Thread(target=self._flush_on_timer,daemon=True) if max_delay else None
+		if self.timer is not None:
+			self.timer.start()
+	def _key(self,item):
+		return {name:item[name] for name in self.key_names}
+	@staticmethod
+	def _merge(key,older,newer):
+		'''
+		Single (op, values) write with the effect of older followed by newer
+		'''
+		op,values = newer
+		if op != 'update':
+			return newer
+		older_op,older_values = older
+		if older_op == 'update':
+			return op,{**older_values,**values}
+		# updating a pending put or delete leaves a put of the resulting item
+		return 'put',{**(older_values if older_op == 'put' else key),**values}
+	def _add(self,key,op,values):
+		cache_key = self.dynamo.cache_key(key)
+		with self.lock:
+			self.received += 1
+			previous = self.pending.pop(cache_key,None)
+			self.pending[cache_key] = (op,values) if previous is None else self._merge(key,previous,(op,values))
+			if self.pending_since is None:
+				self.pending_since = time.monotonic()
+			full = len(self.pending) >= self.max_items
+		if full:
+			self.flush()
+	def put(self,item):
+		self._add(self._key(item),'put',dict(item))
+	def update(self,key,values):
+		'''
+		Set the attributes in values on key
+		'''
+		values = {name:value for name,value in values.items() if name not in self.key_names}
+		self._add(self._key(key),'update',values)
+	def delete(self,key):
+		key = self._key(key)
+		self._add(key,'delete',key)
+	def _requeue(self,cache_key,write):
+		'''
+		Put a failed write back, a write received for the key since the flush started is applied after it
+		'''
+		with self.lock:
+			newer = self.pending.get(cache_key)
+			if newer is None:
+				self.pending[cache_key] = write
+			else:
+				self.pending[cache_key] = self._merge(dict(zip(self.key_names,cache_key[1:])),write,newer)
+			if self.pending_since is None:
+				self.pending_since = time.monotonic()
+	def _written(self,cache_key):
+		self.sent += 1
+		if self.dynamo.item_cache is not None:
+			self.dynamo.item_cache.invalidate(cache_key)
+	def flush(self):
+		'''
+		Send every pending write, raises the first error after requeueing the writes that failed
+		Any write not confirmed as sent is put back, whatever the error (ClientError, connection errors, timeouts...)
+		'''
+		with self.flush_lock:
+			with self.lock:
+				pending = self.pending
+				self.pending = OrderedDict()
+				self.pending_since = None
+			if not pending:
+				return
+			start = time.monotonic()
+			requests = {}
+			updates = []
+			for cache_key,(op,values) in pending.items():
+				if op == 'put':
+					requests[cache_key] = {'PutRequest':{'Item':values}}
+				elif op == 'delete':
+					requests[cache_key] = {'DeleteRequest':{'Key':values}}
+				else:
+					updates.append((cache_key,values))
+			error = None
+			handled = set()
+			try:
+				keys = list(requests)
+				for i in range(0,len(keys),WRITE_BATCH_SIZE):
+					batch = keys[i:i + WRITE_BATCH_SIZE]
+					try:
+						_,_,unprocessed = self.dynamo._write_batch_with_retry([requests[k] for k in batch],max_retries=self.max_retries)
+					except (ClientError,BotoCoreError) as err:
+						error = error or err
+						unprocessed = [requests[k] for k in batch]
+					failed = {self.dynamo.cache_key(r['PutRequest']['Item'] if 'PutRequest' in r else r['DeleteRequest']['Key']) for r in unprocessed}
+					for k in batch:
+						if k in failed:
+							self._requeue(k,pending[k])
+						else:
+							self._written(k)
+						handled.add(k)
+				table = self.dynamo.thread_table()
+				for cache_key,values in updates:
+					key = dict(zip(self.key_names,cache_key[1:]))
+					try:
+						if values:
+							table.update_item(Key=key,**set_expression(values))
+						self._written(cache_key)
+					except (ClientError,BotoCoreError) as err:
+						error = error or err
+						self._requeue(cache_key,pending[cache_key])
+					handled.add(cache_key)
+			finally:
+				# an unexpected error must not drop the writes that were never sent
+				for cache_key,write in pending.items():
+					if cache_key not in handled:
+						self._requeue(cache_key,write)
+			seconds = time.monotonic() - start
+			self.flushes += 1
+			self.flush_seconds += seconds
+			self.max_flush_seconds = max(self.max_flush_seconds,seconds)
+			logger.debug(f'{self.dynamo.table.name} write buffer flushed {len(pending)} keys in {seconds:.3f}s')
+			if error is not None:
+				self.dynamo.parse_client_error(error,f'{self.dynamo.table.name} write buffer flush')
+				raise error
+	def _flush_on_timer(self):
+		while not self.closed.wait(min(self.max_delay,0.1) if self.max_delay else 0.1):
+			with self.lock:
+				due = self.pending_since is not None and time.monotonic() - self.pending_since >= self.max_delay
+			if due:
+				try:
+					self.flush()
+				except Exception as e:
+					logger.error(f'{self.dynamo.table.name} write buffer timed flush failed: {e}')
+	def stats(self):
+		'''
+		Coalescing ratio is received writes per write sent
+		'''
+		return {
+			'received':self.received,
+			'sent':self.sent,
+			'pending':len(self.pending),
+			'coalescing_ratio':self.received / self.sent if self.sent else 0.0,
+			'flushes':self.flushes,
+			'mean_flush_seconds':self.flush_seconds / self.flushes if self.flushes else 0.0,
+			'max_flush_seconds':self.max_flush_seconds,
+		}
+	def close(self):
+		self.closed.set()
+		if self.timer is not None and self.timer is not threading.current_thread():
+			self.timer.join()
+		self.flush()
+	def __enter__(self):
+		return self
+	def __exit__(self,*exc):
+		self.close()
+
+class Dynamo():
+	'''
+	Wraps a DynamoDB.ServiceResource, resource methods not defined here are delegated to it
 	https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html
 	'''
-	def __init__(self):
-		super().__init__('dynamodb')
+	def __init__(self,resource=None):
+		self.resource = resource or boto3.resource('dynamodb')
+		self.local = threading.local()
+		self.item_cache = None
+		self.write_buffer = None
+	def __getattr__(self,name):
+		if name == 'resource':
+			raise AttributeError(name)
+		return getattr(self.resource,name)
+	def enable_write_buffer(self,max_items=100,max_delay=1.0,max_retries=8):
+		'''
+		Route put, update (without expression kwargs) and delete through a coalescing WriteBuffer
+		Call write_buffer.close() or flush() before exiting so no writes are lost
+		'''
+		self.write_buffer = WriteBuffer(self,max_items,max_delay,max_retries)
+		return self.write_buffer
+	def disable_write_buffer(self):
+		if self.write_buffer is not None:
+			write_buffer,self.write_buffer = self.write_buffer,None
+			write_buffer.close()
+	def enable_item_cache(self,max_items=10000,ttl=60,negative_ttl=None):
+		'''
+		Read-through cache behind get and batch_get, invalidated by writes through this object
+		Use item_cache.stats() for hit and miss counts
+		'''
+		self.item_cache = ItemCache(max_items,ttl,negative_ttl)
+		return self.item_cache
+	def cache_key(self,key):
+		'''
+		Hashable cache key for a key dict or item
+		'''
+		return (self.table.name,) + tuple(key[name] for name in self.key_names())
+	def invalidate(self,key):
+		if self.item_cache is not None:
+			self.item_cache.invalidate(self.cache_key(key))
+	def thread_table(self):
+		'''
+		Table for the calling thread, resources are not thread safe so worker threads get their own resource
+		It shares the (thread safe) client of self.resource, keeping its region, endpoint and credentials
+		'''
+		if threading.current_thread() is threading.main_thread():
+			return self.table
+		table = getattr(self.local,'table',None)
+		if table is None or table.name != self.table.name:
+			table = type(self.resource)(client=self.resource.meta.client).Table(self.table.name)
+			self.local.table = table
+		return table
+	@staticmethod
 	def parse_client_error(ce,resource,message=''):
 		'''
 		All client exceptions are raised as ClientError
@@ -36,8 +650,8 @@ class Dynamo(boto3.resource):
 			logger.error(f"Private {resource}. Forbidden Access!{message}")
 		elif error_code == 404:
 			logger.error(f"{resource} Does Not Exist!{message}")
-		ce['Error']['Error Code'] = error_code
-		return ce['Error']
+		ce.response['Error']['Error Code'] = error_code
+		return ce.response['Error']
 	def exists(self, table_name):
 		"""
 		Determines whether a table exists. As a side effect, stores the table in
@@ -54,7 +668,7 @@ class Dynamo(boto3.resource):
 			if err.response['Error']['Code'] == 'ResourceNotFoundException':
 				exists = False
 			else:
-				self.parse_client_error(table_name,err)
+				self.parse_client_error(err,table_name)
 		else:
 			self.table = table
 		return exists
@@ -70,7 +684,7 @@ class Dynamo(boto3.resource):
 		:return: The newly created table.
 		"""
 		try:
-			self.table = self.create_table(
+			self.table = self.resource.create_table(
 				TableName=table_name,
 				KeySchema=[
 					{'AttributeName': 'year', 'KeyType': 'HASH'},  # Partition key
@@ -83,7 +697,7 @@ class Dynamo(boto3.resource):
 				ProvisionedThroughput={'ReadCapacityUnits': 10, 'WriteCapacityUnits': 10})
 			self.table.wait_until_exists()
 		except ClientError as err:
-			self.parse_client_error(table_name,err)
+			self.parse_client_error(err,table_name)
 			raise
 		else:
 			return self.table
@@ -100,88 +714,398 @@ class Dynamo(boto3.resource):
 				print(table.name)
 				tables.append(table)
 		except ClientError as err:
-			self.parse_client_error('list_tables',err)
+			self.parse_client_error(err,'list_tables')
 			raise
 		else:
 			return tables
 
+	def key_names(self):
+		'''
+		Partition and sort key attribute names of the table
+		'''
+		return [key['AttributeName'] for key in self.table.key_schema]
+
 	def write_batch(self, items):
 		
+		if self.write_buffer is not None:
+			self.write_buffer.flush()
+		sent = []
 		try:
-			with self.table.batch_writer() as writer:
+			with self.table.batch_writer(overwrite_by_pkeys=self.key_names()) as writer:
 				for item in items:
 					writer.put_item(Item=item)
+					sent.append(item)
+		except ClientError as err:
+			self.parse_client_error(err,f'{self.table.name} batch_write')
+			raise
+		finally:
+			# the batch writer has sent everything once it exits
+			for item in sent:
+				self.invalidate(item)
+
+	def dedupe_batches(self,items,batch_size=WRITE_BATCH_SIZE):
+		'''
+		Yield batches of items without repeated primary keys, the last item for a key wins
+		'''
+		key_names = self.key_names()
+		batch = OrderedDict()
+		for item in items:
+			key = tuple(item[name] for name in key_names)
+			batch.pop(key,None)
+			batch[key] = item
+			if len(batch) >= batch_size:
+				yield list(batch.values())
+				batch = OrderedDict()
+		if batch:
+			yield list(batch.values())
+
+	def _write_batch_with_retry(self,requests,throttle=None,max_retries=8,base_delay=0.05,max_delay=5):
+		'''
+		batch_write_item retrying UnprocessedItems with full jitter exponential backoff
+		Returns (consumed WCU, retries, requests still unprocessed)
+		'''
+		client = self.thread_table().meta.client
+		consumed = 0.0
+		retries = 0
+		while requests:
+			if throttle is not None:
+				throttle.wait()
+			response = client.batch_write_item(RequestItems={self.table.name:requests},ReturnConsumedCapacity='TOTAL')
+			if throttle is not None:
+				consumed += throttle.consume(response)
+			else:
+				consumed += sum(c.get('CapacityUnits',0) for c in response.get('ConsumedCapacity',[]))
+			requests = response.get('UnprocessedItems',{}).get(self.table.name,[])
+			if not requests:
+				break
+			if retries >= max_retries:
+				logger.warning(f'{self.table.name} bulk_write gave up on {len(requests)} unprocessed items after {retries} retries')
+				break
+			time.sleep(backoff_delay(retries,base_delay,max_delay))
+			retries += 1
+		return consumed,retries,requests
+
+	def bulk_write(self,items,max_workers=8,max_wcu=None,max_retries=8):
+		'''
+		Put items with batch_write_item calls sharded across max_workers threads
+		Items repeating a primary key within a batch are de-duplicated (last wins), a batch repeating a key of a batch
+		still in flight waits for it so the last item still wins. Unprocessed items are retried with jittered backoff
+		and max_wcu caps the write capacity units per second.
+		Returns {'items', 'seconds', 'items_per_second', 'consumed_wcu', 'retries', 'unprocessed'}
+		'''
+		if self.write_buffer is not None:
+			self.write_buffer.flush()
+		throttle = CapacityThrottle(max_wcu) if max_wcu else None
+		stats = {'items':0,'seconds':0.0,'items_per_second':0.0,'consumed_wcu':0.0,'retries':0,'unprocessed':[]}
+		start = time.monotonic()
+		key_names = self.key_names()
+		futures = {}
+		inflight = {}
+
+		def collect(future):
+			keys = futures.pop(future)
+			for key in keys:
+				if inflight.get(key) is future:
+					del inflight[key]
+				if self.item_cache is not None:
+					self.item_cache.invalidate((self.table.name,) + key)
+			consumed,retries,unprocessed = future.result()
+			stats['items'] += len(keys) - len(unprocessed)
+			stats['consumed_wcu'] += consumed
+			stats['retries'] += retries
+			stats['unprocessed'].extend(request['PutRequest']['Item'] for request in unprocessed)
+
+		try:
+			with ThreadPoolExecutor(max_workers=max_workers) as executor:
+				for batch in self.dedupe_batches(items):
+					while len(futures) >= 2 * max_workers:
+						finished,_ = wait(futures,return_when=FIRST_COMPLETED)
+						for future in finished:
+							collect(future)
+					keys = [tuple(item[name] for name in key_names) for item in batch]
+					conflicts = {inflight[key] for key in keys if key in inflight}
+					if conflicts:
+						# an earlier item for one of these keys is still being written
+						wait(conflicts)
+						for future in conflicts:
+							collect(future)
+					requests = [{'PutRequest':{'Item':item}} for item in batch]
+					future = executor.submit(self._write_batch_with_retry,requests,throttle,max_retries)
+					futures[future] = keys
+					inflight.update((key,future) for key in keys)
+				while futures:
+					finished,_ = wait(futures,return_when=FIRST_COMPLETED)
+					for future in finished:
+						collect(future)
 		except ClientError as err:
-			self.parse_client_error(f'{self.table.name} batch_write',err)
+			self.parse_client_error(err,f'{self.table.name} bulk_write')
 			raise
+		stats['seconds'] = time.monotonic() - start
+		stats['items_per_second'] = stats['items'] / stats['seconds'] if stats['seconds'] else 0.0
+		logger.info(
+			f"{self.table.name} bulk_write: {stats['items']} items in {stats['seconds']:.1f}s "
+			f"({stats['items_per_second']:.0f}/s), {stats['consumed_wcu']:.1f} WCU, {stats['retries']} retries, "
+			f"{len(stats['unprocessed'])} unprocessed"
+		)
+		return stats
 
 	def put(self, item):
 		
+		if self.write_buffer is not None:
+			return self.write_buffer.put(item)
 		try:
 			self.table.put_item(Item=item)
 		except ClientError as err:
-			self.parse_client_error(f'{self.table.name} put',err)
+			self.parse_client_error(err,f'{self.table.name} put')
 			raise
+		finally:
+			self.invalidate(item)
 
-	def get(self, key):
-		
+	def get(self, key, **kwargs):
+		'''
+		Item for key, raises KeyError when it does not exist
+		Served from the item cache when enabled, kwargs (e.g. ProjectionExpression) bypass the cache
+		'''
+		cache_key = self.cache_key(key) if self.item_cache is not None and not kwargs else None
+		if cache_key is not None:
+			item = self.item_cache.get(cache_key)
+			if item is MISSING:
+				raise KeyError(key)
+			if item is not None:
+				return item
 		try:
-			response = self.table.get_item(Key=key)
+			response = self.table.get_item(Key=key,**kwargs)
 		except ClientError as err:
-			self.parse_client_error(f'{self.table.name} get',err)
+			self.parse_client_error(err,f'{self.table.name} get')
 			raise
-		else:
-			return response['Item']
+		item = response.get('Item',MISSING)
+		if cache_key is not None:
+			self.item_cache.set(cache_key,item)
+		if item is MISSING:
+			raise KeyError(key)
+		return item
+
+	def batch_get(self, keys, max_retries=8, **kwargs):
+		'''
+		Items for keys in the same order, None for keys that do not exist
+		Keys are fetched with batch_get_item calls of 100 keys and UnprocessedKeys are retried with jittered backoff.
+		Served from the item cache when enabled, kwargs (e.g. ProjectionExpression) bypass the cache.
+		Key attributes are added to a ProjectionExpression to match the results and left out of them unless projected.
+		https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/batch_get_item.html
+		'''
+		keys = list(keys)
+		key_names = self.key_names()
+		use_cache = self.item_cache is not None and not kwargs
+		unprojected = []
+		if 'ProjectionExpression' in kwargs:
+			kwargs,unprojected = self.project_keys(kwargs)
+		found = {}
+		wanted = OrderedDict()
+		for key in keys:
+			cache_key = self.cache_key(key)
+			item = self.item_cache.get(cache_key) if use_cache else None
+			if item is None:
+				wanted[cache_key] = {name:key[name] for name in key_names}
+			else:
+				found[cache_key] = item
+		client = self.table.meta.client
+		wanted_keys = list(wanted.values())
+		try:
+			for i in range(0,len(wanted_keys),GET_BATCH_SIZE):
+				request = {self.table.name:dict(kwargs,Keys=wanted_keys[i:i + GET_BATCH_SIZE])}
+				retries = 0
+				while request:
+					response = client.batch_get_item(RequestItems=request)
+					for item in response.get('Responses',{}).get(self.table.name,[]):
+						cache_key = self.cache_key(item)
+						for name in unprojected:
+							del item[name]
+						found[cache_key] = item
+					request = response.get('UnprocessedKeys')
+					if not request:
+						break
+					if retries >= max_retries:
+						raise RuntimeError(f'{self.table.name} batch_get: {len(request[self.table.name]["Keys"])} keys unprocessed after {retries} retries')
+					time.sleep(backoff_delay(retries))
+					retries += 1
+		except ClientError as err:
+			self.parse_client_error(err,f'{self.table.name} batch_get')
+			raise
+		if use_cache:
+			for cache_key in wanted:
+				self.item_cache.set(cache_key,found.get(cache_key,MISSING))
+		result = []
+		for key in keys:
+			item = found.get(self.cache_key(key),MISSING)
+			result.append(None if item is MISSING else item)
+		return result
+
+	def project_keys(self,kwargs):
+		'''
+		kwargs with the key attributes added to its ProjectionExpression, and the key names it did not project
+		'''
+		names = dict(kwargs.get('ExpressionAttributeNames') or {})
+		# top level attribute of each projected path, e.g. #n for #n.b[0]
+		projected = {names.get(name,name) for name in (re.split(r'[.\[]',path.strip())[0] for path in kwargs['ProjectionExpression'].split(','))}
+		unprojected = [name for name in self.key_names() if name not in projected]
+		if not unprojected:
+			return kwargs,[]
+		placeholders = []
+		for i,name in enumerate(unprojected):
+			names[f'#key{i}'] = name
+			placeholders.append(f'#key{i}')
+		kwargs = dict(kwargs,ProjectionExpression=', '.join([kwargs['ProjectionExpression']] + placeholders),ExpressionAttributeNames=names)
+		return kwargs,unprojected
 
 	def update(self, key,item,**kwargs):
-		
+		'''
+		SET the attributes of item on key, kwargs are passed to update_item
+		item must be empty when kwargs hold their own UpdateExpression.
+		With a write buffer and no kwargs the update is buffered and None returned, otherwise returns the
+		Attributes asked for with ReturnValues
+		'''
+		key_names = self.key_names()
+		item = {name:value for name,value in (item or {}).items() if name not in key_names}
+		if item and 'UpdateExpression' in kwargs:
+			raise ValueError('update takes either item or an UpdateExpression, not both')
+		if self.write_buffer is not None:
+			if not kwargs:
+				return self.write_buffer.update(key,item)
+			# keep the order of writes to this key
+			self.write_buffer.flush()
+		if item:
+			kwargs.update(set_expression(item))
 		try:
 			response = self.table.update_item(
 				Key=key,**kwargs)
 		except ClientError as err:
-			self.parse_client_error(f'{self.table.name} update',err)
+			self.parse_client_error(err,f'{self.table.name} update')
 			raise
 		else:
-			return response['Attributes']
+			return response.get('Attributes')
+		finally:
+			self.invalidate(key)
 
 	def query(self, key,value):
-		
+		'''
+		All items with key equal to value, every page is read
+		'''
+		return list(self.query_stream(key,value))
+
+	def key_condition(self,key,value,sort_key=None,sort_op='eq',sort_value=None):
+		'''
+		KeyConditionExpression for key == value and optionally sort_key <sort_op> sort_value
+		sort_op is one of eq, lt, lte, gt, gte, begins_with or between with sort_value a (low, high) pair
+		'''
+		condition = Key(key).eq(value)
+		if sort_key is not None:
+			values = sort_value if sort_op == 'between' else (sort_value,)
+			condition = condition & getattr(Key(sort_key),sort_op)(*values)
+		return condition
+
+	def query_pages(self,key,value,sort_key=None,sort_op='eq',sort_value=None,index_name=None,limit=None,page_size=None,start_key=None,**kwargs):
+		'''
+		Yield query response pages until the partition is exhausted or limit items were returned
+		Each page's LastEvaluatedKey is a cursor, pass it back as start_key to resume after that page.
+		When limit stops the query the last page ends exactly at the limit so its cursor resumes at the next item.
+		index_name selects a GSI or LSI, kwargs (ProjectionExpression, FilterExpression, ScanIndexForward...) are passed to every query call
+		https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/table/query.html
+		'''
+		query_kwargs = dict(kwargs,KeyConditionExpression=self.key_condition(key,value,sort_key,sort_op,sort_value))
+		if index_name:
+			query_kwargs['IndexName'] = index_name
+		if start_key:
+			query_kwargs['ExclusiveStartKey'] = start_key
+		remaining = limit
 		try:
-			response = self.table.query(KeyConditionExpression=Key(key).eq(value))
+			while remaining is None or remaining > 0:
+				limits = [x for x in (remaining,page_size) if x]
+				if limits:
+					query_kwargs['Limit'] = min(limits)
+				response = self.table.query(**query_kwargs)
+				if remaining is not None:
+					remaining -= len(response.get('Items',[]))
+				yield response
+				start_key = response.get('LastEvaluatedKey')
+				if start_key is None:
+					return
+				query_kwargs['ExclusiveStartKey'] = start_key
 		except ClientError as err:
-			self.parse_client_error(f'{self.table.name} query',err)
+			self.parse_client_error(err,f'{self.table.name} query')
 			raise
-		else:
-			return response['Items']
+
+	def query_stream(self,key,value,**kwargs):
+		'''
+		Yield queried items across all pages, kwargs are passed to query_pages
+		'''
+		for page in self.query_pages(key,value,**kwargs):
+			yield from page.get('Items',[])
 
 	def scan_movies(self, year_range):
-		movies = []
 		scan_kwargs = {
 			'FilterExpression': Key('year').between(year_range['first'], year_range['second']),
 			'ProjectionExpression': "#yr, title, info.rating",
 			'ExpressionAttributeNames': {"#yr": "year"}}
+		return list(self.scan(**scan_kwargs))
+
+	def scan_segment(self,segment=None,total_segments=None,throttle=None,**kwargs):
+		'''
+		Yield the items of one scan segment page by page
+		https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/table/scan.html
+		'''
+		table = self.thread_table()
+		scan_kwargs = dict(kwargs)
+		if total_segments:
+			scan_kwargs['Segment'] = segment
+			scan_kwargs['TotalSegments'] = total_segments
+		if throttle is not None:
+			scan_kwargs['ReturnConsumedCapacity'] = 'TOTAL'
 		try:
-			done = False
-			start_key = None
-			while not done:
-				if start_key:
-					scan_kwargs['ExclusiveStartKey'] = start_key
-				response = self.table.scan(**scan_kwargs)
-				movies.extend(response.get('Items', []))
-				start_key = response.get('LastEvaluatedKey', None)
-				done = start_key is None
+			while True:
+				if throttle is not None:
+					throttle.wait()
+				response = table.scan(**scan_kwargs)
+				if throttle is not None:
+					throttle.consume(response)
+				yield from response.get('Items',[])
+				start_key = response.get('LastEvaluatedKey')
+				if start_key is None:
+					return
+				scan_kwargs['ExclusiveStartKey'] = start_key
 		except ClientError as err:
-			self.parse_client_error(f'{self.table.name} scan',err)
+			self.parse_client_error(err,f'{self.table.name} scan')
 			raise
 
-		return movies
+	def scan(self,total_segments=1,max_workers=None,max_rcu=None,max_buffered=1000,**kwargs):
+		'''
+		Yield scanned items as pages arrive
+		With total_segments > 1 the table is scanned as a parallel scan of total_segments segments on max_workers threads
+		(default one per segment), items are then yielded in no particular order.
+		max_rcu caps the read capacity units per second consumed by all segments together.
+		kwargs such as FilterExpression, ProjectionExpression or ExpressionAttributeNames are passed to every scan call
+		'''
+		throttle = CapacityThrottle(max_rcu) if max_rcu else None
+		if total_segments <= 1:
+			yield from self.scan_segment(throttle=throttle,**kwargs)
+			return
+		tasks = [
+			lambda segment=segment: self.scan_segment(segment,total_segments,throttle,**kwargs)
+			for segment in range(total_segments)
+		]
+		yield from stream_tasks(tasks,max_workers or total_segments,max_buffered)
+		if throttle is not None:
+			logger.info(f'{self.table.name} scan of {total_segments} segments consumed {throttle.consumed:.1f} RCU')
 
 	def delete(self, key):
+		if self.write_buffer is not None:
+			return self.write_buffer.delete(key)
 		try:
 			self.table.delete_item(Key=key)
 		except ClientError as err:
-			self.parse_client_error(f'{self.table.name} delete',err)
+			self.parse_client_error(err,f'{self.table.name} delete')
 			raise
+		finally:
+			self.invalidate(key)
 
 	def delete_table(self):
 		"""
@@ -191,6 +1115,21 @@ class Dynamo(boto3.resource):
 			self.table.delete()
 			self.table = None
 		except ClientError as err:
-			self.parse_client_error(f'{self.table.name} delete_table',err)
+			self.parse_client_error(err,f'{self.table.name} delete_table')
 			raise
 
+	def export(self,path,items=None,format='parquet',columns=None,chunk_size=100000,dtypes=None,**kwargs):
+		'''
+		Write items (default: a scan with kwargs) to path as Parquet or CSV through a ColumnarExporter
+		Pass items=self.query_stream(...) to export a query
+		Returns {'rows', 'seconds'}
+		'''
+		if items is None:
+			items = self.scan(**kwargs)
+		start = time.monotonic()
+		with ColumnarExporter(path,format,columns,chunk_size,dtypes) as exporter:
+			exporter.write(items)
+		exporter_rows = exporter.rows
+		seconds = time.monotonic() - start
+		logger.info(f'{self.table.name} export: {exporter_rows} rows to {path} in {seconds:.1f}s')
+		return {'rows':exporter_rows,'seconds':seconds}
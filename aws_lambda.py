@@ -1,8 +1,23 @@
 import os
+import sys
 import subprocess
 import shutil
 import argparse
 import zipfile
+import base64
+import csv
+import hashlib
+import io
+import fnmatch
+import importlib.util
+import json
+import marshal
+import re
+import shlex
+import sysconfig
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import boto3
 from platform import platform
 import glob
@@ -14,6 +29,22 @@ import glob
 #     def __init__(self) -> None:
 #          super().__init__('lambda')
 
+CACHE_DIR = os.environ.get('AWS_LAMBDA_CACHE',os.path.join(os.path.expanduser('~'),'.cache','aws_lambda'))
+SOURCE_MANIFEST = '.source_hashes.json'
+# written by the build itself, not sources of the function
+GENERATED_SOURCES = ('setup.py','__init__.py')
+# requirements left to install in the function zip once shared ones moved to a layer
+FUNCTION_REQUIREMENTS = 'requirements.function.txt'
+# paths (relative, / separated) or path components matching these are left out of zips
+DEFAULT_EXCLUDES = (
+	'__pycache__','*.pyc','*.pyo','*.dist-info','*.egg-info','tests','test','*.zip',
+	SOURCE_MANIFEST,FUNCTION_REQUIREMENTS,'setup.py','.git','.DS_Store',
+)
+# update_function_code accepts zips up to 50 MB directly, larger ones have to be staged in S3
+DIRECT_UPLOAD_LIMIT = 50 * 1024 ** 2
+# 1980-01-01 is the earliest timestamp a zip entry can hold
+ZIP_DATE_TIME = (1980,1,1,0,0,0)
+
 def run_subprocess(args):
 	'''
 	use subprocess.run to run command line args
@@ -21,12 +52,14 @@ def run_subprocess(args):
 	print(args)
 	if not 'Windows' in platform():
 		if isinstance(args,str):
-			args = [args]
+			args = shlex.split(args)
 	try:
 		cp = subprocess.run(args,shell=False,capture_output=True,text=True)
 		cp.check_returncode()
-	except subprocess.CalledProcessError as err:
+		return True
+	except (subprocess.CalledProcessError,OSError) as err:
 		print(err)
+		return False
 def check_path(path):
 	'''
 	If path is a file then make a new directory with the name of the file
@@ -76,50 +109,368 @@ def create_setup(name,**kwargs):
 	install_requires=['wheel', 'bar', 'greek'], #external packages as dependencies
 	)'''
 
-def create_requirements_txt(path):
+def create_requirements_txt(path,force=False):
 	'''
-	create requirements.txt for directory path
+	create requirements.txt for directory path, returns False when pipreqs fails
+	An existing requirements.txt is only overwritten with force
 	'''
-	run_subprocess(f'pipreqs --encoding utf-8 {quote_path(path)}')
+	created = run_subprocess(f'pipreqs {"--force " if force else ""}--encoding utf-8 {quote_path(path)}')
 	create_init_setup(path,'setup')
+	return created
 
-def install_requirements(path):
+def install_requirements(path,platform_tag=None,python_version=None,shared=()):
 	'''
 	install requirements.txt to target package
+	Installs are cached by requirements and target platform, a warm build links the cached tree into the package
+	Requirements in shared are left out and distributions the layer installed in the same version are pruned from
+	the package, otherwise a function dependency needing numpy would bring its own copy and shadow the layer
+	(/var/task comes before /opt/python on sys.path). Only pass shared for functions the layer is attached to.
 	'''
 	
+	requirements = function_requirements(path,shared)
+	cache_dir = cached_requirements(requirements,platform_tag,python_version) if path_exists(requirements) else None
+	if cache_dir:
+		# start from a clean package so dependencies dropped from requirements.txt go away
+		shutil.rmtree(f'{path}/package',ignore_errors=True)
 	if not path_exists(f'{path}/package'):
 		os.mkdir(f'{path}/package')
 		create_init_setup(f'{path}/package')
-	#--target utf-8
-	run_subprocess(f'pip install -t {quote_path(clean_path(path,"package"))} -r {quote_path(clean_path(path,"requirements.txt"))}')
-def zip_package(path):
+	if cache_dir:
+		link_tree(cache_dir,clean_path(path,'package'))
+	else:
+		#--target utf-8
+		run_subprocess(f'pip install -t {quote_path(clean_path(path,"package"))} -r {quote_path(requirements)}')
+	if shared:
+		pruned = prune_layer_packages(clean_path(path,'package'),layer_cache_dir(shared,platform_tag,python_version))
+		if pruned:
+			print(f'{base_name(path)}: left {", ".join(pruned)} to the layer')
+
+def installed_distributions(site_dir):
+	'''
+	{normalised name: (version, dist-info directory)} of the distributions installed in site_dir
+	'''
+	distributions = {}
+	if not os.path.isdir(site_dir):
+		return distributions
+	for entry in os.listdir(site_dir):
+		if entry.endswith('.dist-info') and '-' in entry:
+			name,version = entry[:-len('.dist-info')].split('-',1)
+			distributions[re.sub(r'[-_.]+','_',name).lower()] = (version,entry)
+	return distributions
+
+def remove_distribution(site_dir,dist_info):
+	'''
+	Delete the files RECORD lists for dist_info and the directories left empty
+	Files are only unlinked, they may be hard links into the dependency cache. Returns False without a RECORD
+	'''
+	site_dir = os.path.abspath(site_dir)
+	try:
+		with open(os.path.join(site_dir,dist_info,'RECORD'),newline='',encoding='utf-8') as f:
+			paths = [row[0] for row in csv.reader(f) if row]
+	except OSError:
+		return False
+	dirs = set()
+	for rel_path in paths:
+		target = os.path.normpath(os.path.join(site_dir,rel_path))
+		if os.path.commonpath([target,site_dir]) != site_dir:
+			continue
+		if os.path.lexists(target) and not os.path.isdir(target):
+			os.remove(target)
+		dirs.add(os.path.dirname(target))
+	shutil.rmtree(os.path.join(site_dir,dist_info),ignore_errors=True)
+	for directory in sorted(dirs,key=len,reverse=True):
+		while directory != site_dir and os.path.isdir(directory) and not set(os.listdir(directory)) - {'__pycache__'}:
+			shutil.rmtree(directory)
+			directory = os.path.dirname(directory)
+	return True
+
+def prune_layer_packages(package_dir,layer_dir):
+	'''
+	Remove the distributions of package_dir that layer_dir has in the same version
+	A different version is kept (it shadows the layer for this function) and reported. Returns the removed name==version
+	'''
+	package_dir = unquote_path(package_dir)
+	layer = installed_distributions(layer_dir)
+	pruned = []
+	for name,(version,dist_info) in sorted(installed_distributions(package_dir).items()):
+		if name not in layer:
+			continue
+		if layer[name][0] != version:
+			print(f'{package_dir}: keeping {name} {version}, the layer has {layer[name][0]}')
+			continue
+		if remove_distribution(package_dir,dist_info):
+			pruned.append(f'{name}=={version}')
+	return pruned
+
+def read_requirements(requirements):
+	'''
+	Set of normalised requirement lines, comments and blank lines dropped
+	'''
+	with open(unquote_path(requirements),'r',encoding='utf-8') as f:
+		return {line.split('#')[0].strip().lower() for line in f} - {''}
+
+def function_requirements(path,shared=()):
+	'''
+	requirements.txt of path without the shared requirements
+	Without shared requirements.txt itself is returned, otherwise the rest is written to FUNCTION_REQUIREMENTS
+	'''
+	requirements = clean_path(path,'requirements.txt')
+	if not shared or not path_exists(requirements):
+		return requirements
+	rest = clean_path(path,FUNCTION_REQUIREMENTS)
+	with open(unquote_path(rest),'w',encoding='utf-8') as f:
+		f.writelines(f'{line}\n' for line in sorted(read_requirements(requirements) - set(shared)))
+	return rest
+
+def requirements_key(requirements,platform_tag=None,python_version=None):
+	'''
+	sha256 of the normalised requirements and the target platform and python version
+	'''
+	return lines_key(read_requirements(requirements),platform_tag,python_version)
+
+def lines_key(lines,platform_tag=None,python_version=None):
+	lines = sorted(lines)
+	target = [platform_tag or sysconfig.get_platform(),python_version or '.'.join(map(str,sys.version_info[:2]))]
+	return hashlib.sha256(json.dumps([lines,target]).encode()).hexdigest()
+
+def layer_cache_dir(shared,platform_tag=None,python_version=None):
+	'''
+	Dependency cache directory build_layer installs the shared requirements to
+	'''
+	return clean_path(CACHE_DIR,'deps',lines_key(shared,platform_tag,python_version))
+
+def cached_requirements(requirements,platform_tag=None,python_version=None):
+	'''
+	Directory holding requirements installed for the target platform, installed on a cache miss
+	Returns None when pip fails
+	'''
+	key = requirements_key(requirements,platform_tag,python_version)
+	cache_dir = clean_path(CACHE_DIR,'deps',key)
+	if os.path.isdir(cache_dir):
+		print(f'dependency cache hit {key[:12]}')
+		return cache_dir
+	print(f'dependency cache miss {key[:12]}')
+	tmp_dir = f'{cache_dir}.{os.getpid()}.tmp'
+	shutil.rmtree(tmp_dir,ignore_errors=True)
+	os.makedirs(tmp_dir)
+	args = ['pip','install','-t',tmp_dir,'-r',unquote_path(requirements)]
+	if platform_tag:
+		args += ['--platform',platform_tag]
+	if python_version:
+		args += ['--python-version',python_version]
+	if platform_tag or python_version:
+		# pip refuses --platform and --python-version unless it only installs wheels
+		args += ['--only-binary=:all:']
+	if not run_subprocess(args):
+		shutil.rmtree(tmp_dir,ignore_errors=True)
+		return None
+	try:
+		os.rename(tmp_dir,cache_dir)
+	except OSError:
+		# another build filled the cache first
+		shutil.rmtree(tmp_dir,ignore_errors=True)
+	return cache_dir
+
+def link_tree(src,dst):
+	'''
+	Hard link every file of src into dst, copying when linking is not possible (e.g. across devices)
+	'''
+	for root,dirs,files in os.walk(src):
+		target_root = os.path.join(dst,os.path.relpath(root,src))
+		os.makedirs(target_root,exist_ok=True)
+		for f in files:
+			target = os.path.join(target_root,f)
+			if os.path.exists(target):
+				os.remove(target)
+			try:
+				os.link(os.path.join(root,f),target)
+			except OSError:
+				shutil.copy2(os.path.join(root,f),target)
+
+def sources_changed(path):
 	'''
-	Zip package for lambda deployment
+	(changed, hashes): changed is True when a .py file of path changed since hashes were last saved
+	Files are only re-hashed when their size or mtime changed, pass hashes to save_source_hashes once handled.
+	GENERATED_SOURCES are left out, the build writes them after hashing.
 	'''
-	shutil.make_archive(clean_path(path,os.path.basename(path)),format='zip',root_dir=path)
+	manifest_path = clean_path(path,SOURCE_MANIFEST)
+	try:
+		with open(manifest_path,'r') as f:
+			manifest = json.load(f)
+	except (OSError,ValueError):
+		manifest = {}
+	current = {}
+	changed = False
+	for f in sorted(glob.glob(clean_path(path,'*.py'))):
+		name = os.path.basename(f)
+		if name in GENERATED_SOURCES:
+			continue
+		stat = os.stat(f)
+		entry = manifest.get(name)
+		if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+			current[name] = entry
+			continue
+		with open(f,'rb') as source:
+			digest = hashlib.sha256(source.read()).hexdigest()
+		current[name] = {'size':stat.st_size,'mtime':stat.st_mtime_ns,'sha256':digest}
+		changed = changed or not entry or entry['sha256'] != digest
+	changed = changed or set(current) != set(manifest)
+	return changed,current
 
-def prepare_package(path):
+def save_source_hashes(path,hashes):
+	with open(clean_path(path,SOURCE_MANIFEST),'w') as f:
+		json.dump(hashes,f,indent=1)
+
+def excluded(rel_path,excludes=DEFAULT_EXCLUDES):
+	'''
+	True when rel_path or one of its components matches an exclude pattern
+	'''
+	parts = rel_path.split('/')
+	return any(fnmatch.fnmatch(rel_path,pattern) or any(fnmatch.fnmatch(part,pattern) for part in parts) for pattern in excludes)
+
+def compile_source(source,rel_path):
+	'''
+	Hash based .pyc bytes (PEP 552) so the output does not depend on file mtimes
+	'''
+	code = compile(source,rel_path,'exec',dont_inherit=True)
+	# flags 0b11: hash based, checked against the source when it is present
+	return importlib.util.MAGIC_NUMBER + (3).to_bytes(4,'little') + importlib.util.source_hash(source) + marshal.dumps(code)
+
+def build_zip(path,excludes=DEFAULT_EXCLUDES,compile_pyc=False,strip_source=False,compresslevel=9,python_version=None):
+	'''
+	Byte reproducible in memory zip of path
+	Entries are sorted with fixed timestamps, permissions are 0755 for executable files and 0644 otherwise,
+	files matching excludes are skipped.
+	With compile_pyc .py files get a hash based .pyc in __pycache__, with strip_source only the .pyc is kept next to
+	where the source was. Compiling needs the running interpreter to match the target python_version, strip_source
+	requires python_version since a sourceless .pyc for another version fails to import with a bad magic number.
+	Source files on disk are never modified (they may be hard links into the dependency cache).
+	'''
+	if strip_source and not python_version:
+		raise ValueError('strip_source needs python_version to check the .pyc files match the target runtime')
+	if compile_pyc and python_version and python_version != '.'.join(map(str,sys.version_info[:2])):
+		print(f'not compiling: running python {sys.version_info[0]}.{sys.version_info[1]} does not match target {python_version}')
+		compile_pyc = strip_source = False
+	tag = sys.implementation.cache_tag
+	entries = {}
+	path = unquote_path(path)
+	for root,dirs,files in os.walk(path):
+		rel_root = os.path.relpath(root,path).replace(os.sep,'/')
+		rel_root = '' if rel_root == '.' else rel_root + '/'
+		dirs[:] = [d for d in dirs if not excluded(rel_root + d,excludes)]
+		for f in files:
+			rel_path = rel_root + f
+			if excluded(rel_path,excludes):
+				continue
+			with open(os.path.join(root,f),'rb') as source_file:
+				data = source_file.read()
+				mode = 0o755 if os.fstat(source_file.fileno()).st_mode & 0o111 else 0o644
+			if compile_pyc and f.endswith('.py'):
+				try:
+					pyc = compile_source(data,rel_path)
+				except SyntaxError as err:
+					print(f'not compiling {rel_path}: {err}')
+				else:
+					if strip_source:
+						entries[rel_path + 'c'] = (pyc,0o644)
+						continue
+					entries[f'{rel_root}__pycache__/{f[:-3]}.{tag}.pyc'] = (pyc,0o644)
+			entries[rel_path] = (data,mode)
+	buffer = io.BytesIO()
+	with zipfile.ZipFile(buffer,'w',zipfile.ZIP_DEFLATED,compresslevel=compresslevel) as zip_file:
+		for name in sorted(entries):
+			data,mode = entries[name]
+			info = zipfile.ZipInfo(name,date_time=ZIP_DATE_TIME)
+			info.compress_type = zipfile.ZIP_DEFLATED
+			info.create_system = 3
+			info.external_attr = (0o100000 | mode) << 16
+			zip_file.writestr(info,data,compresslevel=compresslevel)
+	return buffer.getvalue()
+
+def zip_package(path,**kwargs):
+	'''
+	Zip package for lambda deployment, kwargs are passed to build_zip
+	Returns the zip bytes
+	'''
+	zip_bytes = build_zip(path,**kwargs)
+	zip_path = package_zip(path)
+	with open(f'{zip_path}.tmp','wb') as f:
+		f.write(zip_bytes)
+	os.replace(f'{zip_path}.tmp',zip_path)
+	return zip_bytes
+
+def prepare_package(path,platform_tag=None,python_version=None,zip_options=None,shared=(),refresh_requirements=False):
 	'''
 	Essentially a main function excluding the deployment step storing everything locally
+	zip_options are passed to build_zip, see stage_package for refresh_requirements
+	Returns the zip bytes
 	'''
-	path = check_path(path)
-	create_requirements_txt(path)
-	install_requirements(path)
-	zip_package(path)
-def deploy_package(path,aws_cli):
+	path = stage_package(path,platform_tag,python_version,refresh_requirements)['path']
+	install_requirements(path,platform_tag,python_version,shared)
+	return zip_package(path,python_version=python_version,**(zip_options or {}))
+_local = threading.local()
+
+def thread_client(service):
+	'''
+	boto3 client from a session of the calling thread, creating clients on the shared default session is not thread safe
+	'''
+	if not hasattr(_local,'session'):
+		_local.session = boto3.session.Session()
+		_local.clients = {}
+	if service not in _local.clients:
+		_local.clients[service] = _local.session.client(service)
+	return _local.clients[service]
+
+def code_sha256(zip_bytes):
+	'''
+	Base64 SHA-256 of a zip, the form Lambda reports as CodeSha256
+	'''
+	return base64.b64encode(hashlib.sha256(zip_bytes).digest()).decode()
+
+def deployed_sha256(lambda_client,function_name):
+	'''
+	CodeSha256 of the deployed function or None when it cannot be read
+	'''
+	try:
+		return lambda_client.get_function(FunctionName=function_name)['Configuration']['CodeSha256']
+	except Exception as err:
+		print(f'could not read CodeSha256 of {function_name}: {err}')
+		return None
+
+def deploy_package(path,aws_cli,zip_bytes=None,skip_unchanged=True,s3_bucket=None,s3_prefix='lambda-packages/'):
 	'''
 	Deploy package to AWS Lambda using AWS CLI or boto3
+	boto3 uploads zip_bytes straight from memory when given, otherwise the zip written by zip_package
+	With skip_unchanged nothing is uploaded when the local SHA-256 matches the deployed CodeSha256.
+	Zips over DIRECT_UPLOAD_LIMIT are staged in s3_bucket.
+	Returns True when the code was updated
 	'''
 	function_name = os.path.splitext(os.path.basename(path))[0]
+	if zip_bytes is None:
+		with open(unquote_path(package_zip(path)),'rb') as zip_file:
+			zip_bytes = zip_file.read()
+	lambda_client = thread_client('lambda')
+	sha256 = code_sha256(zip_bytes)
+	if skip_unchanged and deployed_sha256(lambda_client,function_name) == sha256:
+		print(f'{function_name} unchanged ({sha256}), skipping deploy')
+		return False
+	s3_key = None
+	if len(zip_bytes) > DIRECT_UPLOAD_LIMIT:
+		if not s3_bucket:
+			raise ValueError(f'{function_name} zip is {len(zip_bytes)} bytes, over the direct upload limit: pass s3_bucket')
+		s3_key = f"{s3_prefix}{function_name}/{hashlib.sha256(zip_bytes).hexdigest()}.zip"
+		thread_client('s3').put_object(Bucket=s3_bucket,Key=s3_key,Body=zip_bytes)
 	if aws_cli:
-		args = f'aws lambda update-function-code --function-name {function_name} --zip-file fileb://{quote_path(path)}/{function_name}.zip'
-		run_subprocess(args)
+		if s3_key:
+			args = f'aws lambda update-function-code --function-name {function_name} --s3-bucket {s3_bucket} --s3-key {s3_key}'
+		else:
+			args = f'aws lambda update-function-code --function-name {function_name} --zip-file fileb://{quote_path(path)}/{function_name}.zip'
+		return run_subprocess(args)
+	if s3_key:
+		lambda_client.update_function_code(FunctionName=function_name,S3Bucket=s3_bucket,S3Key=s3_key)
 	else:
-		lambda_client = boto3.client('lambda')
-		with zipfile.ZipFile(path,'r') as zip_file:
-			zip_bytes = zip_file.read()
 		lambda_client.update_function_code(FunctionName=function_name,ZipFile=zip_bytes)
+	return True
 
 def clean_dir(path,exclusions=[],dry_run=True):
 	'''
@@ -175,25 +526,262 @@ def get_py_files(path):
 		for f in files:
 			base_name_ = base_name(f)
 			base_dir = clean_path(path,base_name_)
-			if path_exists(base_dir):
-				continue
 			check_path(base_dir)
-			shutil.copy2(f,clean_path(base_dir,base_name(f)))
+			target = clean_path(base_dir,os.path.basename(f))
+			# refresh the copy when the handler changed so rebuilds pick it up
+			if not path_exists(target) or os.path.getmtime(f) > os.path.getmtime(target):
+				shutil.copy2(f,target)
 			yield base_dir
 	else:
 		yield path
-def main(path,aws_cli,deploy=False,**kwargs):
+def stage_package(path,platform_tag=None,python_version=None,refresh_requirements=False):
+	'''
+	First build step: package directory and requirements.txt, returns the requirements cache key
+	requirements.txt is generated when missing, with refresh_requirements it is also regenerated (overwriting
+	any hand pinned versions) when a source file changed since the last refresh
+	'''
+	start = time.monotonic()
+	path = check_path(path)
+	requirements = clean_path(path,'requirements.txt')
+	if not path_exists(requirements):
+		create_requirements_txt(path)
+	elif refresh_requirements:
+		changed,hashes = sources_changed(path)
+		# a failed pipreqs keeps the old hashes so the next build tries again
+		if not changed or create_requirements_txt(path,force=True):
+			save_source_hashes(path,hashes)
+	key = requirements_key(requirements,platform_tag,python_version) if path_exists(requirements) else None
+	return {'path':path,'key':key,'stage_seconds':time.monotonic() - start}
+
+def finish_package(path,platform_tag=None,python_version=None,zip_options=None,shared=()):
+	'''
+	Second build step: link cached dependencies and zip
+	'''
+	start = time.monotonic()
+	install_requirements(path,platform_tag,python_version,shared)
+	zip_package(path,python_version=python_version,**(zip_options or {}))
+	return {'path':path,'package_seconds':time.monotonic() - start,'size':os.path.getsize(package_zip(path))}
+
+def package_zip(path):
+	'''
+	Zip file written by zip_package
+	'''
+	return clean_path(path,f'{os.path.basename(path)}.zip')
+
+def timed_deploy(path,aws_cli,deploy_options=None):
+	start = time.monotonic()
+	deployed = deploy_package(path,aws_cli,**(deploy_options or {}))
+	return time.monotonic() - start,deployed
+
+def build_all(
+	paths,aws_cli=False,deploy=False,jobs=None,deploy_jobs=4,platform_tag=None,python_version=None,
+	zip_options=None,deploy_options=None,layer_requirements=None,refresh_requirements=False,
+):
+	'''
+	Package functions on a pool of jobs processes and deploy them on a pool of deploy_jobs threads
+	Each distinct requirements.txt is installed once and shared by every function that has it.
+	layer_requirements {path: shared requirements} are left out of those function zips, they are provided by a layer
+	Returns one report row per function
+	'''
+	report = {}
+	layer_requirements = layer_requirements or {}
+	with ProcessPoolExecutor(max_workers=jobs) as pool, ThreadPoolExecutor(max_workers=deploy_jobs) as deploy_pool:
+		staged = list(pool.map(
+			stage_package,paths,[platform_tag] * len(paths),[python_version] * len(paths),[refresh_requirements] * len(paths),
+		))
+		first_by_key = {}
+		for row in staged:
+			report[row['path']] = row
+			if row['key']:
+				requirements = function_requirements(row['path'],layer_requirements.get(row['path'],()))
+				first_by_key.setdefault(requirements_key(requirements,platform_tag,python_version),requirements)
+		print(f'{len(staged)} functions share {len(first_by_key)} dependency sets')
+		list(pool.map(cached_requirements,first_by_key.values(),[platform_tag] * len(first_by_key),[python_version] * len(first_by_key)))
+		builds = {
+			pool.submit(
+				finish_package,row['path'],platform_tag,python_version,zip_options,layer_requirements.get(row['path'],()),
+			):row['path'] for row in staged
+		}
+		deploys = {}
+		for future in as_completed(builds):
+			row = future.result()
+			report[row['path']].update(row)
+			if deploy:
+				deploys[deploy_pool.submit(timed_deploy,row['path'],aws_cli,deploy_options)] = row['path']
+		for future in as_completed(deploys):
+			report[deploys[future]]['deploy_seconds'],report[deploys[future]]['deployed'] = future.result()
+	return list(report.values())
+
+def print_report(report):
+	'''
+	Per function timing and size table
+	'''
+	print(f"{'function':<30} {'stage s':>8} {'package s':>10} {'deploy s':>9} {'zip MB':>8} {'deployed':>9}")
+	for row in sorted(report,key=lambda r: r['path']):
+		deployed = {True:'yes',False:'unchanged'}.get(row.get('deployed'),'-')
+		print(
+			f"{os.path.basename(row['path']):<30} {row.get('stage_seconds',0):>8.2f} {row.get('package_seconds',0):>10.2f} "
+			f"{row.get('deploy_seconds',0):>9.2f} {row.get('size',0) / 1024 ** 2:>8.2f} {deployed:>9}"
+		)
+
+def shared_requirements(paths,min_functions=2):
+	'''
+	Requirements used by at least min_functions of the packages in paths
+	Returns the shared requirements and the paths using any of them
+	'''
+	usage = {}
+	for path in paths:
+		requirements = clean_path(path,'requirements.txt')
+		if path_exists(requirements):
+			usage[path] = read_requirements(requirements)
+	counts = {}
+	for lines in usage.values():
+		for line in lines:
+			counts[line] = counts.get(line,0) + 1
+	shared = {line for line,count in counts.items() if count >= max(min_functions,2)}
+	return shared,[path for path,lines in usage.items() if lines & shared]
+
+def build_layer(shared,platform_tag=None,python_version=None,compresslevel=9):
+	'''
+	Deterministic layer zip of the shared requirements installed under python/
+	Installs go through the dependency cache, returns the zip bytes or None when pip fails
+	'''
+	layer_dir = clean_path(CACHE_DIR,'layers')
+	os.makedirs(layer_dir,exist_ok=True)
+	requirements = clean_path(layer_dir,f'{os.getpid()}.requirements.txt')
+	with open(requirements,'w',encoding='utf-8') as f:
+		f.writelines(f'{line}\n' for line in sorted(shared))
+	try:
+		key = requirements_key(requirements,platform_tag,python_version)
+		cache_dir = cached_requirements(requirements,platform_tag,python_version)
+	finally:
+		os.remove(requirements)
+	if not cache_dir:
+		return None
+	stage_dir = clean_path(layer_dir,key)
+	if not os.path.isdir(stage_dir):
+		link_tree(cache_dir,f'{stage_dir}.{os.getpid()}.tmp/python')
+		try:
+			os.rename(f'{stage_dir}.{os.getpid()}.tmp',stage_dir)
+		except OSError:
+			shutil.rmtree(f'{stage_dir}.{os.getpid()}.tmp',ignore_errors=True)
+	return build_zip(stage_dir,compresslevel=compresslevel)
+
+def publish_layer(layer_name,zip_bytes,python_version=None,s3_bucket=None,s3_prefix='lambda-packages/'):
+	'''
+	Publish the layer zip unless a version with the same content hash exists
+	The sha256 of the zip is kept in the version description, returns the LayerVersionArn
+	'''
+	lambda_client = thread_client('lambda')
+	digest = hashlib.sha256(zip_bytes).hexdigest()
+	description = f'sha256:{digest}'
+	for page in lambda_client.get_paginator('list_layer_versions').paginate(LayerName=layer_name):
+		for version in page['LayerVersions']:
+			if version.get('Description') == description:
+				print(f'layer {layer_name} unchanged ({digest[:12]}), version {version["Version"]}')
+				return version['LayerVersionArn']
+	if len(zip_bytes) > DIRECT_UPLOAD_LIMIT:
+		if not s3_bucket:
+			raise ValueError(f'layer {layer_name} zip is {len(zip_bytes)} bytes, over the direct upload limit: pass s3_bucket')
+		s3_key = f'{s3_prefix}layers/{layer_name}/{digest}.zip'
+		thread_client('s3').put_object(Bucket=s3_bucket,Key=s3_key,Body=zip_bytes)
+		content = {'S3Bucket':s3_bucket,'S3Key':s3_key}
+	else:
+		content = {'ZipFile':zip_bytes}
+	kwargs = {'CompatibleRuntimes':[f'python{python_version}']} if python_version else {}
+	response = lambda_client.publish_layer_version(LayerName=layer_name,Description=description,Content=content,**kwargs)
+	print(f'published layer {layer_name} version {response["Version"]}')
+	return response['LayerVersionArn']
+
+def attach_layer(path,layer_arn):
+	'''
+	Point the function of path at layer_arn, replacing other versions of the same layer
+	Waits for the configuration update so a following code update does not conflict
+	'''
+	lambda_client = thread_client('lambda')
+	function_name = os.path.splitext(os.path.basename(path))[0]
+	layer = layer_arn.rsplit(':',1)[0]
+	current = [l['Arn'] for l in lambda_client.get_function_configuration(FunctionName=function_name).get('Layers',[])]
+	layers = [arn for arn in current if arn.rsplit(':',1)[0] != layer] + [layer_arn]
+	if layers == current:
+		return False
+	lambda_client.update_function_configuration(FunctionName=function_name,Layers=layers)
+	lambda_client.get_waiter('function_updated').wait(FunctionName=function_name)
+	return True
+
+def prepare_layer(
+	paths,layer_name,deploy=False,platform_tag=None,python_version=None,zip_options=None,deploy_options=None,min_functions=2,
+	refresh_requirements=False,
+):
+	'''
+	Move requirements shared by at least min_functions of paths into layer_name
+	The layer zip is written to CACHE_DIR, with deploy it is published when its hash changed and attached
+	to the functions using it. Returns {path: shared requirements} for the functions the layer is meant for,
+	only those leave the shared requirements out of their zips
+	'''
+	for path in paths:
+		stage_package(path,platform_tag,python_version,refresh_requirements)
+	shared,users = shared_requirements(paths,min_functions)
+	if not shared:
+		print('no requirements shared by enough functions for a layer')
+		return {}
+	print(f'layer {layer_name}: {", ".join(sorted(shared))} for {len(users)} functions')
+	zip_bytes = build_layer(shared,platform_tag,python_version,(zip_options or {}).get('compresslevel',9))
+	if zip_bytes is None:
+		print('could not install layer requirements, keeping them in the function zips')
+		return {}
+	with open(clean_path(CACHE_DIR,'layers',f'{layer_name}.zip'),'wb') as f:
+		f.write(zip_bytes)
+	if deploy:
+		deploy_options = deploy_options or {}
+		layer_arn = publish_layer(layer_name,zip_bytes,python_version,deploy_options.get('s3_bucket'))
+		for path in users:
+			attach_layer(path,layer_arn)
+	return {path:shared for path in users}
+
+def main(path,aws_cli,deploy=False,jobs=1,deploy_jobs=4,**kwargs):
 	'''
 	Main: just do it
+	With jobs > 1 functions are packaged in parallel, see build_all
 	'''
 	if not path:
 		path = input("Path to deploy")
 	if not path_exists(path):
 		raise FileNotFoundError(unquote_path(path))
+	if kwargs.get('strip_source') and not kwargs.get('python_version'):
+		# fail before staging anything, build_zip would raise the same for every function
+		raise ValueError('--strip_source needs --python_version')
+	zip_options = {
+		'compile_pyc':kwargs.get('compile_pyc',False) or kwargs.get('strip_source',False),
+		'strip_source':kwargs.get('strip_source',False),
+		'compresslevel':kwargs.get('compresslevel',9),
+		'excludes':DEFAULT_EXCLUDES + tuple(kwargs.get('exclude') or ()),
+	}
+	deploy_options = {
+		'skip_unchanged':not kwargs.get('force_deploy',False),
+		's3_bucket':kwargs.get('s3_bucket'),
+	}
+	layer_requirements = {}
+	if kwargs.get('layer'):
+		layer_requirements = prepare_layer(
+			list(get_py_files(path)),kwargs['layer'],deploy,kwargs.get('platform_tag'),kwargs.get('python_version'),
+			zip_options,deploy_options,kwargs.get('layer_min_functions',2),kwargs.get('refresh_requirements',False),
+		)
+	if jobs > 1:
+		report = build_all(
+			list(get_py_files(path)),aws_cli,deploy,jobs,deploy_jobs,
+			kwargs.get('platform_tag'),kwargs.get('python_version'),zip_options,deploy_options,layer_requirements,
+			kwargs.get('refresh_requirements',False),
+		)
+		print_report(report)
+		return report
 	for p in get_py_files(path):
-		prepare_package(p)
+		zip_bytes = prepare_package(
+			p,kwargs.get('platform_tag'),kwargs.get('python_version'),zip_options,layer_requirements.get(p,()),
+			kwargs.get('refresh_requirements',False),
+		)
 		if deploy:
-			deploy_package(p,aws_cli)
+			deploy_package(p,aws_cli,zip_bytes,**deploy_options)
 def main_args():
 	'''
 	ARGS
@@ -202,6 +790,19 @@ def main_args():
 	parser.add_argument('--aws_cli', action='store_true')
 	parser.add_argument('-d','--deploy', action='store_true')
 	parser.add_argument('-p', '--path', type=clean_path, default='')
+	parser.add_argument('--platform_tag', default=None, help='pip --platform for dependencies, e.g. manylinux2014_x86_64')
+	parser.add_argument('--python_version', default=None, help='pip --python-version for dependencies, e.g. 3.11')
+	parser.add_argument('-j', '--jobs', type=int, default=1, help='package functions on this many processes')
+	parser.add_argument('--deploy_jobs', type=int, default=4, help='concurrent deploys when --jobs > 1')
+	parser.add_argument('--exclude', action='append', help='extra glob of paths to leave out of the zip')
+	parser.add_argument('--compile_pyc', action='store_true', help='add hash based .pyc files')
+	parser.add_argument('--strip_source', action='store_true', help='ship .pyc only, implies --compile_pyc, needs --python_version')
+	parser.add_argument('--compresslevel', type=int, default=9, choices=range(0,10))
+	parser.add_argument('--force_deploy', action='store_true', help='deploy even when CodeSha256 matches')
+	parser.add_argument('--s3_bucket', default=None, help='bucket to stage zips over the direct upload limit')
+	parser.add_argument('--layer', default=None, help='move requirements shared by functions into this layer')
+	parser.add_argument('--refresh_requirements', action='store_true', help='regenerate requirements.txt with pipreqs when sources changed, overwrites it')
+	parser.add_argument('--layer_min_functions', type=int, default=2, help='functions that must share a requirement for the layer')
 	args = parser.parse_args()
 	return vars(args)
 if __name__ == "__main__":
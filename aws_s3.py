@@ -1,28 +1,416 @@
 
 import boto3
+import io
 import os
+import time
+import json
+import queue
+import sqlite3
+from collections import OrderedDict
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from boto3.s3.transfer import TransferConfig
 from botocore.client import ClientError
 import logging
 
 
 logger = logging.getLogger(__name__)
 
-class S3Handler(boto3.client):
+MB = 1024 ** 2
+DEFAULT_PART_SIZE = 8 * MB
+# S3 rejects parts smaller than 5 MB (except the last) and uploads over 10,000 parts
+MIN_PART_SIZE = 5 * MB
+MAX_PARTS = 10000
+DEFAULT_MAX_WORKERS = 10
+MANIFEST_NAME = '.s3manifest.json'
+DEFAULT_BLOCK_SIZE = 4 * MB
+# delete_objects accepts at most 1000 keys per request
+DELETE_BATCH_SIZE = 1000
+
+class BandwidthLimiter():
+	'''
+	Token bucket shared by all transfer workers
+	max_bandwidth is in bytes per second, None means unlimited
+	'''
+	def __init__(self,max_bandwidth=None):
+		self.max_bandwidth = max_bandwidth
+		self.lock = threading.Lock()
+		self.allowance = max_bandwidth or 0
+		self.last_check = time.monotonic()
+	def consume(self,amount):
+		if not self.max_bandwidth:
+			return
+		with self.lock:
+			now = time.monotonic()
+			self.allowance = min(self.max_bandwidth,self.allowance + (now - self.last_check) * self.max_bandwidth)
+			self.last_check = now
+			self.allowance -= amount
+			wait = -self.allowance / self.max_bandwidth if self.allowance < 0 else 0
+		if wait:
+			time.sleep(wait)
+
+class TransferProgress():
+	'''
+	Thread safe progress and throughput tracker
+	Can be passed as boto3 Callback and also receives completed parts from multipart_upload
+	'''
+	def __init__(self,total_bytes=0,name='',callback=None):
+		self.total_bytes = total_bytes
+		self.name = name
+		self.callback = callback
+		self.transferred = 0
+		self.parts = {}
+		self.lock = threading.Lock()
+		self.start_time = time.monotonic()
+	def __call__(self,bytes_amount):
+		with self.lock:
+			self.transferred += bytes_amount
+	def part_done(self,part_number,size,seconds):
+		'''
+		Record a completed part and report it
+		'''
+		with self.lock:
+			self.transferred += size
+			self.parts[part_number] = size
+		logger.info(f'{self.name} part {part_number}: {size / MB:.1f} MB in {seconds:.2f}s, '
+			f'{self.percent:.1f}% at {self.throughput / MB:.2f} MB/s')
+		if self.callback:
+			self.callback(part_number,size,self)
+	@property
+	def elapsed(self):
+		return time.monotonic() - self.start_time
+	@property
+	def throughput(self):
+		'''
+		Bytes per second since start
+		'''
+		elapsed = self.elapsed
+		return self.transferred / elapsed if elapsed else 0.0
+	@property
+	def percent(self):
+		if not self.total_bytes:
+			return 100.0
+		return 100.0 * self.transferred / self.total_bytes
+
+def file_etag(path,part_size=DEFAULT_PART_SIZE):
+	'''
+	ETag S3 assigns to path when uploaded with multipart_threshold and multipart_chunksize of part_size
+	Single part uploads get the MD5 hex digest, multipart uploads the MD5 of the part MD5s suffixed with -<part count>
+	'''
+	part_hashes = []
+	md5 = hashlib.md5()
+	with open(path,'rb') as f:
+		while True:
+			chunk = f.read(part_size)
+			if not chunk:
+				break
+			md5.update(chunk)
+			part_hashes.append(hashlib.md5(chunk).digest())
+	if os.path.getsize(path) < part_size:
+		return md5.hexdigest()
+	return f"{hashlib.md5(b''.join(part_hashes)).hexdigest()}-{len(part_hashes)}"
+
+def load_manifest(path):
+	'''
+	Sync manifest of directory path {relative path: {size, mtime, etag}}
+	'''
+	manifest_path = os.path.join(path,MANIFEST_NAME)
+	if not os.path.exists(manifest_path):
+		return {}
+	try:
+		with open(manifest_path,'r') as f:
+			return json.load(f)
+	except (OSError,ValueError) as e:
+		logger.warning(f'Ignoring unreadable manifest {manifest_path}: {e}')
+		return {}
+
+def save_manifest(path,manifest):
+	manifest_path = os.path.join(path,MANIFEST_NAME)
+	tmp_path = manifest_path + '.tmp'
+	with open(tmp_path,'w') as f:
+		json.dump(manifest,f,indent=1,sort_keys=True)
+	os.replace(tmp_path,manifest_path)
+
+class ExistenceCache():
+	'''
+	Thread safe TTL cache of existence checks
+	Missing entries are cached for negative_ttl seconds (defaults to ttl), 0 disables negative caching
+	'''
+	def __init__(self,ttl=60,negative_ttl=None,max_entries=100000):
+		self.ttl = ttl
+		self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+		self.max_entries = max_entries
+		self.entries = {}
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+	def get(self,key):
+		'''
+		Cached True/False or None on a miss
+		'''
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None and entry[1] > time.monotonic():
+				self.hits += 1
+				return entry[0]
+			if entry is not None:
+				del self.entries[key]
+			self.misses += 1
+			return None
+	def set(self,key,exists):
+		ttl = self.ttl if exists else self.negative_ttl
+		if ttl <= 0:
+			return
+		with self.lock:
+			if len(self.entries) >= self.max_entries and key not in self.entries:
+				# drop the oldest insertion
+				del self.entries[next(iter(self.entries))]
+			self.entries[key] = (exists,time.monotonic() + ttl)
+	def invalidate(self,key=None):
+		with self.lock:
+			if key is None:
+				self.entries.clear()
+			else:
+				self.entries.pop(key,None)
+	def stats(self):
+		with self.lock:
+			lookups = self.hits + self.misses
+			return {
+				'hits':self.hits,
+				'misses':self.misses,
+				'hit_rate':self.hits / lookups if lookups else 0.0,
+				'entries':len(self.entries),
+			}
+
+class KeyIndex():
+	'''
+	Persistent SQLite index of the keys in a bucket prefix
+	Answers bulk existence checks locally, call refresh to re-list the prefix
+	'''
+	def __init__(self,path=':memory:'):
+		self.path = path
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(path,check_same_thread=False)
+		with self.connection:
+			self.connection.execute('CREATE TABLE IF NOT EXISTS keys (bucket TEXT, key TEXT, size INTEGER, etag TEXT, PRIMARY KEY (bucket, key))')
+			self.connection.execute('CREATE TABLE IF NOT EXISTS prefixes (bucket TEXT, prefix TEXT, refreshed REAL, PRIMARY KEY (bucket, prefix))')
+	def refresh(self,s3,bucket,prefix='',batch_size=10000,**kwargs):
+		'''
+		Replace the indexed keys under prefix with a fresh listing, kwargs are passed to S3Handler.iter_objects
+		'''
+		with self.lock, self.connection:
+			self.connection.execute("DELETE FROM keys WHERE bucket = ? AND substr(key, 1, ?) = ?",(bucket,len(prefix),prefix))
+			batch = []
+			for obj in s3.iter_objects(bucket,prefix,**kwargs):
+				batch.append((bucket,obj['Key'],obj['Size'],obj['ETag'].strip('"')))
+				if len(batch) >= batch_size:
+					self.connection.executemany('INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?)',batch)
+					batch = []
+			self.connection.executemany('INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?)',batch)
+			self.connection.execute('INSERT OR REPLACE INTO prefixes VALUES (?, ?, ?)',(bucket,prefix,time.time()))
+	def age(self,bucket,prefix=''):
+		'''
+		Seconds since prefix, or a shorter prefix covering it, was last refreshed or None if never
+		'''
+		with self.lock:
+			row = self.connection.execute(
+				'SELECT MAX(refreshed) FROM prefixes WHERE bucket = ? AND substr(?, 1, length(prefix)) = prefix',
+				(bucket,prefix),
+			).fetchone()
+		return time.time() - row[0] if row and row[0] is not None else None
+	def contains(self,bucket,keys,chunk_size=500):
+		'''
+		The subset of keys present in the index
+		'''
+		keys = list(keys)
+		found = set()
+		with self.lock:
+			for i in range(0,len(keys),chunk_size):
+				chunk = keys[i:i + chunk_size]
+				placeholders = ','.join('?' * len(chunk))
+				rows = self.connection.execute(f'SELECT key FROM keys WHERE bucket = ? AND key IN ({placeholders})',[bucket,*chunk])
+				found.update(row[0] for row in rows)
+		return found
+	def add(self,bucket,key,size=None,etag=None):
+		with self.lock, self.connection:
+			self.connection.execute('INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?)',(bucket,key,size,etag))
+	def close(self):
+		self.connection.close()
+
+class S3ObjectReader(io.RawIOBase):
 	'''
-	S3.Client
+	Seekable read only file object over an S3 object
+	Byte ranges of block_size are fetched on demand and kept in an LRU cache of max_blocks blocks.
+	Sequential reads prefetch the next read_ahead blocks on background threads, prefetches count against max_blocks
+	and those outside the window of the block just read are dropped.
+	Ranged gets use IfMatch on the ETag seen when opened so a replaced object is never mixed with the old one.
+	'''
+	def __init__(self,s3,bucket,key,block_size=DEFAULT_BLOCK_SIZE,max_blocks=16,read_ahead=2,**kwargs):
+		self.s3 = s3
+		self.bucket = bucket
+		self.key = key
+		self.block_size = block_size
+		self.max_blocks = max(max_blocks,read_ahead + 1)
+		self.read_ahead = read_ahead
+		self.kwargs = kwargs
+		head = s3.head_object(Bucket=bucket,Key=key,**kwargs)
+		self.size = head['ContentLength']
+		self.etag = head['ETag']
+		self.position = 0
+		self.blocks = OrderedDict()
+		self.inflight = {}
+		self.last_block = None
+		self.lock = threading.Lock()
+		self.executor = ThreadPoolExecutor(max_workers=read_ahead) if read_ahead > 0 else None
+		self.block_count = -(-self.size // block_size)
+	def readable(self):
+		return True
+	def seekable(self):
+		return True
+	def tell(self):
+		return self.position
+	def seek(self,offset,whence=io.SEEK_SET):
+		if whence == io.SEEK_SET:
+			position = offset
+		elif whence == io.SEEK_CUR:
+			position = self.position + offset
+		elif whence == io.SEEK_END:
+			position = self.size + offset
+		else:
+			raise ValueError(f'invalid whence ({whence})')
+		if position < 0:
+			raise ValueError(f'negative seek position {position}')
+		self.position = position
+		return position
+	def _fetch(self,index):
+		start = index * self.block_size
+		end = min(start + self.block_size,self.size) - 1
+		response = self.s3.get_bucket(self.bucket,Key=self.key,Range=f'bytes={start}-{end}',IfMatch=self.etag,**self.kwargs)
+		return response['Body'].read()
+	def _block(self,index):
+		with self.lock:
+			if index in self.blocks:
+				self.blocks.move_to_end(index)
+				data = self.blocks[index]
+				future = None
+			else:
+				data = None
+				future = self.inflight.pop(index,None)
+		if data is None:
+			data = future.result() if future else self._fetch(index)
+			with self.lock:
+				self.blocks[index] = data
+				self._evict()
+		self._prefetch(index)
+		return data
+	def _evict(self):
+		while self.blocks and len(self.blocks) + len(self.inflight) > self.max_blocks:
+			self.blocks.popitem(last=False)
+	def _prefetch(self,index):
+		if index == self.last_block:
+			# another small read inside the same block, the window is already set up
+			return
+		sequential = self.last_block is None or index == self.last_block + 1
+		self.last_block = index
+		if self.executor is None:
+			return
+		window = range(index + 1,min(index + 1 + self.read_ahead,self.block_count)) if sequential else range(0)
+		with self.lock:
+			for ahead in [i for i in self.inflight if i not in window]:
+				# a running fetch can not be cancelled, dropping it lets its data be collected when it finishes
+				self.inflight.pop(ahead).cancel()
+			for ahead in window:
+				if ahead not in self.blocks and ahead not in self.inflight:
+					self.inflight[ahead] = self.executor.submit(self._fetch,ahead)
+			self._evict()
+	def readinto(self,buffer):
+		view = memoryview(buffer).cast('B')
+		filled = 0
+		while filled < len(view) and self.position < self.size:
+			index,offset = divmod(self.position,self.block_size)
+			data = self._block(index)
+			n = min(len(view) - filled,len(data) - offset)
+			view[filled:filled + n] = data[offset:offset + n]
+			filled += n
+			self.position += n
+		return filled
+	def readall(self):
+		buffer = bytearray(max(self.size - self.position,0))
+		n = self.readinto(buffer)
+		return bytes(buffer[:n])
+	def close(self):
+		if self.executor is not None:
+			self.executor.shutdown(wait=False,cancel_futures=True)
+			self.executor = None
+		self.blocks.clear()
+		self.inflight.clear()
+		super().close()
+
+class S3Handler():
+	'''
+	Wraps an S3.Client, client methods not defined here are delegated to it
 	https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#client
 	'''
-	def __init__(self):
-		super().__init__('s3')
+	def __init__(self,part_size=DEFAULT_PART_SIZE,max_workers=DEFAULT_MAX_WORKERS,max_bandwidth=None,client=None):
+		self.client = client or boto3.client('s3')
+		self.set_transfer_config(part_size,max_workers,max_bandwidth)
+		self.exists_cache = None
+
+	def __getattr__(self,name):
+		if name == 'client':
+			raise AttributeError(name)
+		return getattr(self.client,name)
+
+	def enable_exists_cache(self,ttl=60,negative_ttl=None,max_entries=100000):
+		'''
+		Cache bucket_exists, key_exists and keys_exist results for ttl seconds, missing results for negative_ttl
+		Use exists_cache.stats() for hit and miss counts
+		'''
+		self.exists_cache = ExistenceCache(ttl,negative_ttl,max_entries)
+		return self.exists_cache
+
+	def _cache_get(self,cache_key):
+		if self.exists_cache is None:
+			return None
+		return self.exists_cache.get(cache_key)
+
+	def _cache_set(self,cache_key,exists):
+		if self.exists_cache is not None:
+			self.exists_cache.set(cache_key,exists)
+
+	def set_transfer_config(self,part_size=DEFAULT_PART_SIZE,max_workers=DEFAULT_MAX_WORKERS,max_bandwidth=None):
+		'''
+		Tune part size (bytes), worker count and bandwidth cap (bytes/s) used by upload_file, download_file and multipart_upload
+		https://boto3.amazonaws.com/v1/documentation/api/latest/reference/customizations/s3.html#boto3.s3.transfer.TransferConfig
+		'''
+		self.part_size = max(part_size,MIN_PART_SIZE)
+		self.max_workers = max_workers
+		self.max_bandwidth = max_bandwidth
+		self.transfer_config = TransferConfig(
+			multipart_threshold=self.part_size,
+			multipart_chunksize=self.part_size,
+			max_concurrency=max_workers,
+			max_bandwidth=max_bandwidth,
+		)
+		return self.transfer_config
 		
 	def get_bucket(self,bucket,**kwargs):
 		'''
 		https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.get_object
 		'''
 		return self.get_object(Bucket=bucket,**kwargs)
+	def open_object(self,bucket,key,block_size=DEFAULT_BLOCK_SIZE,max_blocks=16,read_ahead=2,**kwargs):
+		'''
+		Seekable file object reading key with ranged get_bucket calls, see S3ObjectReader
+		Can be passed to pandas, zipfile or tarfile to read parts of an object without downloading all of it
+		'''
+		bucket = getattr(bucket,'name',bucket)
+		return S3ObjectReader(self,bucket,key,block_size,max_blocks,read_ahead,**kwargs)
 	def get_bucket_if_exist(self, bucket,**kwargs):
 		if self.bucket_exists(bucket):
 			return self.get_object(Bucket=bucket,**kwargs)
+	@staticmethod
 	def parse_client_error(ce,resource,message=''):
 		'''
 		All client exceptions are raised as ClientError
@@ -40,15 +428,21 @@ class S3Handler(boto3.client):
 			logger.error(f"Private {resource}. Forbidden Access!{message}")
 		elif error_code == 404:
 			logger.error(f"{resource} Does Not Exist!{message}")
-		ce['Error']['Error Code'] = error_code
-		return ce['Error']
-	def bucket_exists(self, bucket):
+		ce.response['Error']['Error Code'] = error_code
+		return ce.response['Error']
+	def bucket_exists(self, bucket, forbidden_exists=True):
 		'''
 		head_bucket only returns metadata
+		A 403 means the bucket name is taken by someone else, returns forbidden_exists and is never cached
 		https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.head_bucket
 		'''
+		cache_key = ('bucket',bucket)
+		cached = self._cache_get(cache_key)
+		if cached is not None:
+			return cached
 		try:
 			self.head_bucket(Bucket=bucket)
+			self._cache_set(cache_key,True)
 			return True
 		except ClientError as e:
 			# If a client error is thrown, then check that it was a 404 error.
@@ -57,7 +451,9 @@ class S3Handler(boto3.client):
 			# error_code = int(e.response['Error']['Code'])
 			error = self.parse_client_error(e,'Bucket',f' Bucket:{bucket}')
 			if error['Error Code'] == 403:
-				return True
+				return forbidden_exists
+			if error['Error Code'] == 404:
+				self._cache_set(cache_key,False)
 			return False
 
 	def create_bucket(self,bucket,raise_if_exists=True,**kwargs):
@@ -67,7 +463,7 @@ class S3Handler(boto3.client):
 		if raise_if_exists:
 			if self.bucket_exists(bucket):
 				raise KeyError(f'bucket: {bucket} exists')
-		return self.create_bucket(bucket,**kwargs)
+		return self.client.create_bucket(Bucket=bucket,**kwargs)
 	def wait(self,waiter,*args,**kwargs):
 		'''
 		https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#waiters
@@ -76,9 +472,19 @@ class S3Handler(boto3.client):
 		waiter = self.get_waiter(waiter)
 		waiter.wait(*args,**kwargs)
 
-	def key_exists(self, bucket, key):
+	def key_exists(self, bucket, key, forbidden_exists=False):
+		'''
+		head_object only returns metadata
+		Without s3:ListBucket S3 answers 403 for missing keys, so a 403 returns forbidden_exists and is never cached
+		https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/head_object.html
+		'''
+		cache_key = ('key',bucket,key)
+		cached = self._cache_get(cache_key)
+		if cached is not None:
+			return cached
 		try:
 			self.head_object(Bucket=bucket, Key=key)
+			self._cache_set(cache_key,True)
 			return True
 		except ClientError as e:
 			# If a client error is thrown, then check that it was a 404 error.
@@ -86,9 +492,47 @@ class S3Handler(boto3.client):
 			# error_code = int(e.response['Error']['Code'])
 			error = self.parse_client_error(e,'Bucket',f' Bucket:{bucket} Key:{key}')
 			if error['Error Code'] == 403:
-				return True
+				return forbidden_exists
+			if error['Error Code'] == 404:
+				self._cache_set(cache_key,False)
 			return False
-		
+
+	def keys_exist(self, bucket, keys, index=None, index_ttl=None, prefix=None, **kwargs):
+		'''
+		{key: exists} for many keys without a HEAD request per key
+		Answers from the exists cache, then from index (a KeyIndex, re-listed when older than index_ttl seconds)
+		or otherwise from one listing of prefix (defaults to the common prefix of keys).
+		kwargs are passed to iter_objects
+		'''
+		bucket = getattr(bucket,'name',bucket)
+		result = {}
+		wanted = set()
+		for key in keys:
+			cached = self._cache_get(('key',bucket,key))
+			if cached is None:
+				wanted.add(key)
+			else:
+				result[key] = cached
+		if not wanted:
+			return result
+		if prefix is None:
+			prefix = os.path.commonprefix(list(wanted))
+		if index is not None:
+			age = index.age(bucket,prefix)
+			if age is None or (index_ttl is not None and age > index_ttl):
+				index.refresh(self,bucket,prefix,**kwargs)
+			found = index.contains(bucket,wanted)
+		else:
+			found = set()
+			for key in self.iter_keys(bucket,prefix,**kwargs):
+				if key in wanted:
+					found.add(key)
+					if len(found) == len(wanted):
+						break
+		for key in wanted:
+			result[key] = key in found
+			self._cache_set(('key',bucket,key),result[key])
+		return result
 
 	def get_all_keys(self, s3_bucket,paginate=True,**kwargs):
 		'''
@@ -96,10 +540,94 @@ class S3Handler(boto3.client):
 		'''
 		if paginate:
 			paginator = self.get_paginator('list_objects_v2')
-			yield from paginator.paginate(s3_bucket,**kwargs)
+			return paginator.paginate(Bucket=s3_bucket,**kwargs)
 		else:
 			return s3_bucket.objects.all()
 
+	def iter_objects(self,bucket,prefix='',max_workers=1,delimiter='/',depth=1,max_buffered=10000,**kwargs):
+		'''
+		Yield every object under prefix one at a time
+		With max_workers > 1 the listing is sharded over the prefixes discovered with delimiter (depth levels deep)
+		and the shards are listed in parallel, objects are then yielded in no particular order.
+		At most max_buffered objects plus one page per worker are held in memory regardless of bucket size.
+		https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/paginator/ListObjectsV2.html
+		'''
+		bucket = getattr(bucket,'name',bucket)
+		if max_workers <= 1:
+			paginator = self.get_paginator('list_objects_v2')
+			for page in paginator.paginate(Bucket=bucket,Prefix=prefix,**kwargs):
+				yield from page.get('Contents',[])
+			return
+		results = queue.Queue(maxsize=max_buffered)
+		stop = threading.Event()
+		lock = threading.Lock()
+		pending = [0]
+		done = object()
+		executor = ThreadPoolExecutor(max_workers=max_workers)
+
+		def put(item):
+			# Block while the consumer is behind but give up once it has gone away
+			while not stop.is_set():
+				try:
+					results.put(item,timeout=0.1)
+					return True
+				except queue.Full:
+					continue
+			return False
+
+		def submit(shard_prefix,levels):
+			with lock:
+				pending[0] += 1
+			try:
+				executor.submit(list_shard,shard_prefix,levels)
+			except RuntimeError:
+				# executor is shutting down because the consumer stopped
+				with lock:
+					pending[0] -= 1
+
+		def list_shard(shard_prefix,levels):
+			try:
+				shard_kwargs = dict(kwargs,Bucket=bucket,Prefix=shard_prefix)
+				if levels > 0:
+					shard_kwargs['Delimiter'] = delimiter
+				paginator = self.get_paginator('list_objects_v2')
+				for page in paginator.paginate(**shard_kwargs):
+					if stop.is_set():
+						return
+					for common_prefix in page.get('CommonPrefixes',[]):
+						submit(common_prefix['Prefix'],levels - 1)
+					for obj in page.get('Contents',[]):
+						if not put(obj):
+							return
+			except Exception as e:
+				put(e)
+			finally:
+				with lock:
+					pending[0] -= 1
+					finished = pending[0] == 0
+				if finished:
+					put(done)
+
+		submit(prefix,depth)
+		try:
+			while True:
+				item = results.get()
+				if item is done:
+					break
+				if isinstance(item,Exception):
+					raise item
+				yield item
+		finally:
+			stop.set()
+			executor.shutdown(wait=True)
+
+	def iter_keys(self,bucket,prefix='',**kwargs):
+		'''
+		Yield every key under prefix, kwargs are passed to iter_objects
+		'''
+		for obj in self.iter_objects(bucket,prefix,**kwargs):
+			yield obj['Key']
+
 	def download_file(self, bucket, key, file,**kwargs):
 		'''
 		wraps
@@ -107,15 +635,15 @@ class S3Handler(boto3.client):
 		and
 		https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.download_fileobj
 		'''
-		if isinstance(bucket,boto3.S3.Bucket):
-			bucket = bucket.name
+		bucket = getattr(bucket,'name',bucket)
 		try:
 			
+			kwargs.setdefault('Config',self.transfer_config)
 			if isinstance(file,str):
-				self.download_file(bucket, key, file,**kwargs)
+				self.client.download_file(bucket, key, file,**kwargs)
 			else:
 				# dst must be an open file like object in binary mode
-				self.download_fileobj(bucket, key, file,**kwargs)
+				self.client.download_fileobj(bucket, key, file,**kwargs)
 			return True
 		except ClientError as e:
 			self.parse_client_error(e,'Bucket',f' Bucket:{bucket} Key:{key}, download_file: {file}')	
@@ -127,19 +655,349 @@ class S3Handler(boto3.client):
 		and
 		https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.upload_fileobj
 		'''
-		if isinstance(bucket,boto3.S3.Bucket):
-			bucket = bucket.name
+		bucket = getattr(bucket,'name',bucket)
 		try:
 			
+			kwargs.setdefault('Config',self.transfer_config)
 			if isinstance(file,str):
-				if 'base_name_key' in kwargs:
+				if kwargs.pop('base_name_key',False):
 					base_name = os.path.basename(file)
 					key = base_name
-				self.upload_file(file,bucket, key, **kwargs)
+				self.client.upload_file(file,bucket, key, **kwargs)
 			else:
 				# dst must be an open file like object in binary mode
-				self.upload_fileobj(file,bucket, key, **kwargs)
+				self.client.upload_fileobj(file,bucket, key, **kwargs)
+			self._cache_set(('key',bucket,key),True)
 			return True
 		except ClientError as e:
 			self.parse_client_error(e,'Bucket',f' Bucket:{bucket} Key:{key}, upload_file: {file}')				
 		return False
+
+	def find_multipart_upload(self,bucket,key):
+		'''
+		Most recent incomplete multipart upload for key or None
+		https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/list_multipart_uploads.html
+		'''
+		uploads = []
+		paginator = self.get_paginator('list_multipart_uploads')
+		for page in paginator.paginate(Bucket=bucket,Prefix=key):
+			uploads.extend(u for u in page.get('Uploads',[]) if u['Key'] == key)
+		if not uploads:
+			return None
+		return max(uploads,key=lambda u: u['Initiated'])['UploadId']
+
+	def list_uploaded_parts(self,bucket,key,upload_id):
+		'''
+		{PartNumber: part} for parts already stored by upload_id
+		https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/list_parts.html
+		'''
+		parts = {}
+		paginator = self.get_paginator('list_parts')
+		for page in paginator.paginate(Bucket=bucket,Key=key,UploadId=upload_id):
+			for part in page.get('Parts',[]):
+				parts[part['PartNumber']] = part
+		return parts
+
+	@staticmethod
+	def _part_etag(file,offset,size):
+		'''
+		Quoted MD5 of a local chunk, the ETag S3 stores for a part uploaded without SSE-KMS
+		'''
+		with open(file,'rb') as f:
+			f.seek(offset)
+			return f'"{hashlib.md5(f.read(size)).hexdigest()}"'
+
+	def _upload_part(self,file,bucket,key,upload_id,part_number,offset,size,limiter,progress):
+		start = time.monotonic()
+		with open(file,'rb') as f:
+			f.seek(offset)
+			body = f.read(size)
+		limiter.consume(size)
+		response = self.upload_part(Bucket=bucket,Key=key,UploadId=upload_id,PartNumber=part_number,Body=body)
+		progress.part_done(part_number,size,time.monotonic() - start)
+		return {'PartNumber':part_number,'ETag':response['ETag']}
+
+	def multipart_upload(self,file,bucket,key,part_size=None,max_workers=None,max_bandwidth=None,resume=True,callback=None,**kwargs):
+		'''
+		Parallel multipart upload of a local file
+		Parts are uploaded by max_workers threads sharing a max_bandwidth (bytes/s) cap.
+		If resume an incomplete upload for the same key is continued, stored parts whose size and ETag match the MD5 of
+		the local chunk are skipped and the rest re-uploaded (SSE-KMS parts never match and are always re-uploaded).
+		A failed upload is left open so a later call can resume it, use abort_multipart_upload to discard it.
+		callback(part_number,size,progress) is called after each part, kwargs are passed to create_multipart_upload.
+		A resumed upload keeps the ContentType, SSE and other settings it was created with and kwargs are ignored,
+		pass resume=False when they change
+		https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/create_multipart_upload.html
+		'''
+		bucket = getattr(bucket,'name',bucket)
+		file_size = os.path.getsize(file)
+		part_size = max(part_size or self.part_size,MIN_PART_SIZE,-(-file_size // MAX_PARTS))
+		max_workers = max_workers or self.max_workers
+		limiter = BandwidthLimiter(max_bandwidth if max_bandwidth is not None else self.max_bandwidth)
+		progress = TransferProgress(file_size,f'{bucket}/{key}',callback)
+		offsets = {n + 1:offset for n,offset in enumerate(range(0,max(file_size,1),part_size))}
+		try:
+			upload_id = self.find_multipart_upload(bucket,key) if resume else None
+			completed = {}
+			if upload_id:
+				for number,part in self.list_uploaded_parts(bucket,key,upload_id).items():
+					if number not in offsets or part['Size'] != min(part_size,file_size - offsets[number]):
+						continue
+					if part['ETag'] != self._part_etag(file,offsets[number],part['Size']):
+						# the local file changed since this part was stored
+						continue
+					completed[number] = {'PartNumber':number,'ETag':part['ETag']}
+					progress(part['Size'])
+				logger.info(f'Resuming upload {upload_id} for {bucket}/{key}: {len(completed)} of {len(offsets)} parts done')
+			else:
+				upload_id = self.create_multipart_upload(Bucket=bucket,Key=key,**kwargs)['UploadId']
+			with ThreadPoolExecutor(max_workers=max_workers) as executor:
+				futures = [
+					executor.submit(self._upload_part,file,bucket,key,upload_id,number,offset,min(part_size,file_size - offset),limiter,progress)
+					for number,offset in offsets.items() if number not in completed
+				]
+				for future in as_completed(futures):
+					part = future.result()
+					completed[part['PartNumber']] = part
+			self.complete_multipart_upload(
+				Bucket=bucket,Key=key,UploadId=upload_id,
+				MultipartUpload={'Parts':[completed[n] for n in sorted(completed)]},
+			)
+			self._cache_set(('key',bucket,key),True)
+			logger.info(f'Uploaded {file} to {bucket}/{key}: {file_size / MB:.1f} MB in {progress.elapsed:.1f}s at {progress.throughput / MB:.2f} MB/s')
+			return True
+		except ClientError as e:
+			self.parse_client_error(e,'Bucket',f' Bucket:{bucket} Key:{key}, multipart_upload: {file}')
+		return False
+
+	def _local_etag(self,file,rel_path,manifest):
+		'''
+		ETag of file reusing the manifest entry when size and mtime are unchanged
+		'''
+		stat = os.stat(file)
+		entry = manifest.get(rel_path)
+		if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns and entry.get('etag'):
+			return entry['etag']
+		etag = file_etag(file,self.part_size)
+		manifest[rel_path] = {'size':stat.st_size,'mtime':stat.st_mtime_ns,'etag':etag}
+		return etag
+
+	def _remote_etags(self,bucket,prefix):
+		'''
+		{key: (size, etag)} for every object under prefix from one listing
+		'''
+		return {
+			obj['Key']:(obj['Size'],obj['ETag'].strip('"'))
+			for obj in self.iter_objects(bucket,prefix,max_workers=self.max_workers)
+		}
+
+	def upload_directory(self,path,bucket,prefix='',max_workers=None,use_manifest=True,**kwargs):
+		'''
+		Incrementally sync directory path to bucket/prefix
+		Files whose size and ETag match the listed object are skipped, local ETags are cached in a manifest so unchanged files are not re-hashed.
+		Returns {'uploaded': [keys], 'skipped': [keys], 'failed': [keys]}
+		'''
+		bucket = getattr(bucket,'name',bucket)
+		prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+		manifest = load_manifest(path) if use_manifest else {}
+		remote = self._remote_etags(bucket,prefix)
+		result = {'uploaded':[],'skipped':[],'failed':[]}
+		pending = {}
+		for root,dirs,files in os.walk(path):
+			for name in files:
+				file = os.path.join(root,name)
+				rel_path = os.path.relpath(file,path).replace(os.sep,'/')
+				if rel_path in (MANIFEST_NAME,MANIFEST_NAME + '.tmp'):
+					continue
+				key = prefix + rel_path
+				etag = self._local_etag(file,rel_path,manifest)
+				if remote.get(key) == (os.path.getsize(file),etag):
+					result['skipped'].append(key)
+				else:
+					pending[key] = file
+		with ThreadPoolExecutor(max_workers=max_workers or self.max_workers) as executor:
+			futures = {executor.submit(self.upload_file,file,bucket,key,**kwargs):key for key,file in pending.items()}
+			for future in as_completed(futures):
+				result['uploaded' if future.result() else 'failed'].append(futures[future])
+		if use_manifest:
+			save_manifest(path,manifest)
+		logger.info(f"upload_directory {path} -> {bucket}/{prefix}: {len(result['uploaded'])} uploaded, {len(result['skipped'])} skipped, {len(result['failed'])} failed")
+		return result
+
+	def download_prefix(self,bucket,prefix,path,max_workers=None,use_manifest=True,**kwargs):
+		'''
+		Incrementally sync bucket/prefix to directory path
+		Objects whose local copy has the same size and ETag are skipped, keys that would land outside path
+		(e.g. a/../../x) are not downloaded and reported as failed.
+		Returns {'downloaded': [keys], 'skipped': [keys], 'failed': [keys]}
+		'''
+		bucket = getattr(bucket,'name',bucket)
+		root = os.path.abspath(path)
+		prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+		os.makedirs(path,exist_ok=True)
+		manifest = load_manifest(path) if use_manifest else {}
+		result = {'downloaded':[],'skipped':[],'failed':[]}
+		pending = {}
+		for key,(size,etag) in self._remote_etags(bucket,prefix).items():
+			rel_path = key[len(prefix):]
+			if not rel_path or key.endswith('/'):
+				continue
+			file = os.path.abspath(os.path.join(root,*rel_path.split('/')))
+			if file == root or os.path.commonpath([root,file]) != root:
+				logger.warning(f'download_prefix: {key} resolves outside {path}, skipped')
+				result['failed'].append(key)
+				continue
+			if os.path.isfile(file) and os.path.getsize(file) == size and self._local_etag(file,rel_path,manifest) == etag:
+				result['skipped'].append(key)
+				continue
+			os.makedirs(os.path.dirname(file),exist_ok=True)
+			pending[key] = (file,rel_path,etag)
+		with ThreadPoolExecutor(max_workers=max_workers or self.max_workers) as executor:
+			futures = {executor.submit(self.download_file,bucket,key,file,**kwargs):key for key,(file,_,_) in pending.items()}
+			for future in as_completed(futures):
+				key = futures[future]
+				if future.result():
+					file,rel_path,etag = pending[key]
+					stat = os.stat(file)
+					manifest[rel_path] = {'size':stat.st_size,'mtime':stat.st_mtime_ns,'etag':etag}
+					result['downloaded'].append(key)
+				else:
+					result['failed'].append(key)
+		if use_manifest:
+			save_manifest(path,manifest)
+		logger.info(f"download_prefix {bucket}/{prefix} -> {path}: {len(result['downloaded'])} downloaded, {len(result['skipped'])} skipped, {len(result['failed'])} failed")
+		return result
+
+	def batch_operation(self,items,operation,batch_size=DELETE_BATCH_SIZE,max_workers=None,dry_run=False,name='batch_operation'):
+		'''
+		Stream items into batches of batch_size and run operation(batch) on max_workers threads
+		At most two batches per worker are in flight so items can be a listing of any size.
+		operation returns a list of error dicts each with the failed 'Key'.
+		If dry_run nothing is called and every item is reported as succeeded.
+		Returns {'succeeded': [items], 'errors': [errors], 'dry_run': dry_run}
+		'''
+		max_workers = max_workers or self.max_workers
+		result = {'succeeded':[],'errors':[],'dry_run':dry_run}
+
+		def collect(future):
+			batch = futures.pop(future)
+			try:
+				errors = future.result()
+			except ClientError as e:
+				error = self.parse_client_error(e,'Bucket',f' {name} batch of {len(batch)}')
+				errors = [{'Key':item,'Code':error['Code'],'Message':error['Message']} for item in batch]
+			failed = {error['Key'] for error in errors}
+			result['errors'].extend(errors)
+			result['succeeded'].extend(item for item in batch if item not in failed)
+
+		def batches():
+			batch = []
+			for item in items:
+				batch.append(item)
+				if len(batch) >= batch_size:
+					yield batch
+					batch = []
+			if batch:
+				yield batch
+
+		futures = {}
+		with ThreadPoolExecutor(max_workers=max_workers) as executor:
+			for batch in batches():
+				if dry_run:
+					logger.info(f'{name} dry run: {len(batch)} items, first {batch[0]}')
+					result['succeeded'].extend(batch)
+					continue
+				while len(futures) >= 2 * max_workers:
+					finished,_ = wait(futures,return_when=FIRST_COMPLETED)
+					for future in finished:
+						collect(future)
+				futures[executor.submit(operation,batch)] = batch
+			while futures:
+				collect(next(iter(as_completed(futures))))
+		logger.info(f"{name}: {len(result['succeeded'])} succeeded, {len(result['errors'])} failed{' (dry run)' if dry_run else ''}")
+		return result
+
+	def delete_keys(self,bucket,keys,dry_run=False,max_workers=None):
+		'''
+		Delete keys with delete_objects calls of 1000 keys each
+		https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/delete_objects.html
+		'''
+		bucket = getattr(bucket,'name',bucket)
+
+		def delete_batch(batch):
+			response = self.delete_objects(Bucket=bucket,Delete={'Objects':[{'Key':key} for key in batch],'Quiet':True})
+			errors = response.get('Errors',[])
+			failed = {error['Key'] for error in errors}
+			for key in batch:
+				if key not in failed:
+					self._cache_set(('key',bucket,key),False)
+			return errors
+
+		return self.batch_operation(keys,delete_batch,DELETE_BATCH_SIZE,max_workers,dry_run,f'delete {bucket}')
+
+	def delete_prefix(self,bucket,prefix,dry_run=False,max_workers=None,allow_empty_prefix=False,**kwargs):
+		'''
+		Delete every key under prefix while it is being listed, kwargs are passed to iter_keys
+		An empty prefix deletes the whole bucket and needs allow_empty_prefix
+		'''
+		bucket = getattr(bucket,'name',bucket)
+		if not prefix and not allow_empty_prefix:
+			raise ValueError(f'refusing to delete every key in {bucket} without allow_empty_prefix')
+		return self.delete_keys(bucket,self.iter_keys(bucket,prefix,**kwargs),dry_run,max_workers)
+
+	def copy_keys(self,bucket,keys,dst_bucket,key_map=None,dry_run=False,max_workers=None,batch_size=100,**kwargs):
+		'''
+		Server side copy of keys to dst_bucket, key_map(key) gives the destination key (defaults to the same key)
+		kwargs are passed to copy_object
+		https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/copy_object.html
+		'''
+		bucket = getattr(bucket,'name',bucket)
+		dst_bucket = getattr(dst_bucket,'name',dst_bucket)
+		key_map = key_map or (lambda key: key)
+
+		def copy_batch(batch):
+			errors = []
+			for key in batch:
+				dst_key = key_map(key)
+				try:
+					self.copy_object(Bucket=dst_bucket,Key=dst_key,CopySource={'Bucket':bucket,'Key':key},**kwargs)
+					self._cache_set(('key',dst_bucket,dst_key),True)
+				except ClientError as e:
+					errors.append({'Key':key,'Code':e.response['Error']['Code'],'Message':e.response['Error']['Message']})
+			return errors
+
+		return self.batch_operation(keys,copy_batch,batch_size,max_workers,dry_run,f'copy {bucket} -> {dst_bucket}')
+
+	def copy_prefix(self,bucket,prefix,dst_bucket,dst_prefix,dry_run=False,max_workers=None,**kwargs):
+		'''
+		Copy every key under prefix to dst_prefix in dst_bucket, kwargs are passed to copy_object
+		'''
+		return self.copy_keys(
+			bucket,self.iter_keys(bucket,prefix),dst_bucket,
+			lambda key: dst_prefix + key[len(prefix):],dry_run,max_workers,**kwargs
+		)
+
+	def tag_keys(self,bucket,keys,tags,dry_run=False,max_workers=None,batch_size=100):
+		'''
+		Replace the tag set of keys with tags {name: value}
+		https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/put_object_tagging.html
+		'''
+		bucket = getattr(bucket,'name',bucket)
+		tag_set = {'TagSet':[{'Key':name,'Value':value} for name,value in tags.items()]}
+
+		def tag_batch(batch):
+			errors = []
+			for key in batch:
+				try:
+					self.put_object_tagging(Bucket=bucket,Key=key,Tagging=tag_set)
+				except ClientError as e:
+					errors.append({'Key':key,'Code':e.response['Error']['Code'],'Message':e.response['Error']['Message']})
+			return errors
+
+		return self.batch_operation(keys,tag_batch,batch_size,max_workers,dry_run,f'tag {bucket}')
+
+	def tag_prefix(self,bucket,prefix,tags,dry_run=False,max_workers=None):
+		'''
+		Replace the tag set of every key under prefix
+		'''
+		return self.tag_keys(bucket,self.iter_keys(bucket,prefix),tags,dry_run,max_workers)
@@ -1,8 +1,15 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 
 REGION_NAME = "us-east-2"
 
+_clients = {}
+_clients_lock = threading.Lock()
+
 
 def new_session(region_name=REGION_NAME):
 	session = boto3.session.Session()
@@ -13,15 +20,142 @@ def new_session(region_name=REGION_NAME):
 	return client
 
 
+def get_client(region_name=REGION_NAME):
+	"""
+	Secrets Manager client for region_name, created once and reused (clients are thread safe)
+	"""
+	client = _clients.get(region_name)
+	if client is None:
+		with _clients_lock:
+			client = _clients.get(region_name)
+			if client is None:
+				client = new_session(region_name=region_name)
+				_clients[region_name] = client
+	return client
+
+
+def secret_value(response):
+	"""
+	SecretString or SecretBinary of a get_secret_value response
+	"""
+	if "SecretString" in response:
+		return response["SecretString"]
+	return response["SecretBinary"]
+
+
+class SecretCache:
+	"""
+	In memory secret cache keyed by name, version and region
+	Values are fresh for ttl seconds. Until stale_ttl seconds they are still returned while a background
+	thread refreshes them (stale-while-revalidate), older values are fetched synchronously.
+	Errors are never cached, a failed background refresh keeps serving the stale value until stale_ttl.
+	"""
+
+	def __init__(self, ttl=300, stale_ttl=3600, max_workers=2):
+		self.ttl = ttl
+		self.stale_ttl = max(stale_ttl, ttl)
+		self.entries = {}
+		self.refreshing = set()
+		self.lock = threading.Lock()
+		self.executor = ThreadPoolExecutor(max_workers=max_workers)
+		self.hits = 0
+		self.stale_hits = 0
+		self.misses = 0
+
+	def _fetch(self, key):
+		secret_name, version_id, version_stage, region_name = key
+		kwargs = {}
+		if version_id:
+			kwargs["VersionId"] = version_id
+		if version_stage:
+			kwargs["VersionStage"] = version_stage
+		response = get_client(region_name).get_secret_value(SecretId=secret_name, **kwargs)
+		value = secret_value(response)
+		with self.lock:
+			self.entries[key] = (value, time.monotonic())
+		return value
+
+	def _refresh(self, key):
+		try:
+			self._fetch(key)
+		except (ClientError, BotoCoreError) as e:
+			# connection errors and timeouts are BotoCoreError, nothing else would report them from the executor
+			print("Background refresh of secret " + key[0] + " failed:", e)
+		finally:
+			with self.lock:
+				self.refreshing.discard(key)
+
+	def get(self, secret_name, version_id=None, version_stage=None, region_name=REGION_NAME):
+		"""
+		Secret value, raises ClientError when it cannot be fetched
+		"""
+		key = (secret_name, version_id, version_stage, region_name)
+		with self.lock:
+			entry = self.entries.get(key)
+			age = time.monotonic() - entry[1] if entry else None
+			if entry and age < self.ttl:
+				self.hits += 1
+				return entry[0]
+			if entry and age < self.stale_ttl:
+				self.stale_hits += 1
+				if key not in self.refreshing:
+					self.refreshing.add(key)
+					self.executor.submit(self._refresh, key)
+				return entry[0]
+			self.misses += 1
+		return self._fetch(key)
+
+	def put(self, secret_name, value, version_id=None, version_stage=None, region_name=REGION_NAME):
+		with self.lock:
+			self.entries[(secret_name, version_id, version_stage, region_name)] = (value, time.monotonic())
+
+	def invalidate(self, secret_name=None):
+		with self.lock:
+			if secret_name is None:
+				self.entries.clear()
+			else:
+				for key in [k for k in self.entries if k[0] == secret_name]:
+					del self.entries[key]
+
+	def stats(self):
+		with self.lock:
+			return {
+				"hits": self.hits,
+				"stale_hits": self.stale_hits,
+				"misses": self.misses,
+				"entries": len(self.entries),
+			}
+
+
+SECRET_CACHE = SecretCache()
+
+
+def cached_secret(secret_name="Test-Key-Name", region_name=REGION_NAME, version_id=None, version_stage=None):
+	"""
+	Secret value from SECRET_CACHE, repeated lookups are in memory
+	"""
+	return SECRET_CACHE.get(secret_name, version_id, version_stage, region_name)
+
+
 def get_secret(
-	client=None, secret_name="Test-Key-Name", region_name=REGION_NAME, **kwargs
+	client=None, secret_name="Test-Key-Name", region_name=REGION_NAME, cache=None, **kwargs
 ):
+	"""
+	Secret value, None when it cannot be fetched
+	Without a client lookups go through cache (default SECRET_CACHE, False to skip) unless kwargs other than
+	VersionId and VersionStage are given
+	"""
 	# secret_name = "MySecretName"
 	# region_name = "us-west-2"
+	if cache is None:
+		cache = SECRET_CACHE
+	use_cache = client is None and cache is not False and set(kwargs) <= {"VersionId", "VersionStage"}
 	if client is None:
-		client = new_session(region_name=region_name)
+		client = get_client(region_name=region_name)
 
 	try:
+		if use_cache:
+			return cache.get(secret_name, kwargs.get("VersionId"), kwargs.get("VersionStage"), region_name)
 		get_secret_value_response = client.get_secret_value(
 			SecretId=secret_name, **kwargs
 		)
@@ -42,12 +176,8 @@ def get_secret(
 		# Secrets Manager decrypts the secret value using the associated KMS CMK
 		# Depending on whether the secret was a string or binary, only one of these fields will be populated
 
-		secret_data = (
-			get_secret_value_response["SecretString"]
-			if "SecretString" in get_secret_value_response
-			else get_secret_value_response["SecretBinary"]
-		)
-		print("Secret Key: {} Secret Value: {}".format(secret_name, secret_data))
+		secret_data = secret_value(get_secret_value_response)
+		return secret_data
 		# if 'SecretString' in get_secret_value_response:
 		# 	text_secret_data = get_secret_value_response['SecretString']
 		# 	print(text_secret_data)
@@ -56,11 +186,53 @@ def get_secret(
 		# 	print(binary_secret_data)
 
 
-def list_secrets(client=None, region_name=REGION_NAME, **kwargs):
+def secret_filters(name_prefix=None, tags=None):
+	"""
+	list_secrets / batch_get_secret_value Filters for a name prefix and tag keys and values
+	"""
+	filters = []
+	if name_prefix:
+		filters.append({"Key": "name", "Values": [name_prefix]})
+	for tag_key, tag_value in (tags or {}).items():
+		filters.append({"Key": "tag-key", "Values": [tag_key]})
+		if tag_value is not None:
+			filters.append({"Key": "tag-value", "Values": [tag_value]})
+	return filters
+
+
+def has_tags(secret, tags):
+	"""
+	Filters match tag keys and values independently, check they appear as pairs
+	"""
+	secret_tags = {tag["Key"]: tag.get("Value") for tag in secret.get("Tags", [])}
+	return all(
+		key in secret_tags and (value is None or secret_tags[key] == value)
+		for key, value in (tags or {}).items()
+	)
+
+
+def iter_secrets(client=None, region_name=REGION_NAME, name_prefix=None, tags=None, **kwargs):
+	"""
+	Yield the metadata of every secret page by page, optionally filtered by name prefix and tags {key: value or None}
+	"""
 	if client is None:
-		client = new_session(region_name=region_name)
+		client = get_client(region_name=region_name)
+	filters = secret_filters(name_prefix, tags) + kwargs.pop("Filters", [])
+	if filters:
+		kwargs["Filters"] = filters
+	paginator = client.get_paginator("list_secrets")
+	for page in paginator.paginate(**kwargs):
+		for secret in page["SecretList"]:
+			if has_tags(secret, tags):
+				yield secret
+
+
+def list_secrets(client=None, region_name=REGION_NAME, **kwargs):
+	"""
+	Metadata of every secret across all pages, kwargs are passed to iter_secrets
+	"""
 	try:
-		secrets = client.list_secrets(**kwargs)
+		return list(iter_secrets(client, region_name, **kwargs))
 	except ClientError as e:
 		if e.response["Error"]["Code"] == "ResourceNotFoundException":
 			print("The requested resource was not found")
@@ -74,9 +246,91 @@ def list_secrets(client=None, region_name=REGION_NAME, **kwargs):
 			)
 		elif e.response["Error"]["Code"] == "InternalServiceError":
 			print("An error occurred on service side:", e)
+
+
+def _batch_get_secrets(client, secret_ids=None, filters=None):
+	"""
+	Yield (name, value) pairs with BatchGetSecretValue, 20 secrets per call
+	"""
+	requests = []
+	if secret_ids:
+		for i in range(0, len(secret_ids), 20):
+			requests.append({"SecretIdList": secret_ids[i : i + 20]})
 	else:
-		for secret in secrets["SecretList"]:
-			print("Secret Name: {} Secret Data: {}".format(secret["Name"], secret))
+		requests.append({"Filters": filters, "MaxResults": 20})
+	for request in requests:
+		while True:
+			response = client.batch_get_secret_value(**request)
+			for error in response.get("Errors", []):
+				print("Secret {} could not be retrieved: {} {}".format(
+					error.get("SecretId"), error.get("ErrorCode"), error.get("Message")
+				))
+			for secret in response.get("SecretValues", []):
+				yield secret["Name"], secret_value(secret)
+			if not response.get("NextToken"):
+				break
+			request = dict(request, NextToken=response["NextToken"])
+
+
+def get_secrets(
+	secret_names=None,
+	region_name=REGION_NAME,
+	name_prefix=None,
+	tags=None,
+	client=None,
+	cache=None,
+	max_workers=8,
+):
+	"""
+	{name: value} for secret_names or every secret matching name_prefix and tags (not both)
+	Values are stored in cache (default SECRET_CACHE, False to skip) so later cached_secret calls are in memory
+	Uses BatchGetSecretValue when the client supports it and the caller is allowed to,
+	otherwise get_secret_value on max_workers threads
+	"""
+	if secret_names is not None and (name_prefix or tags):
+		raise ValueError("secret_names can not be combined with name_prefix or tags")
+	if client is None:
+		client = get_client(region_name=region_name)
+	secrets = {}
+	batched = False
+	if hasattr(client, "batch_get_secret_value"):
+		try:
+			filters = secret_filters(name_prefix, tags)
+			if secret_names is None and not filters:
+				# BatchGetSecretValue needs ids or filters
+				secret_names = [secret["Name"] for secret in iter_secrets(client, region_name)]
+			for name, value in _batch_get_secrets(client, list(secret_names or []), filters):
+				secrets[name] = value
+			if tags and secret_names is None:
+				matching = {secret["Name"] for secret in iter_secrets(client, region_name, name_prefix, tags)}
+				secrets = {name: value for name, value in secrets.items() if name in matching}
+			batched = True
+		except ClientError as e:
+			if e.response["Error"]["Code"] not in ("AccessDeniedException", "AccessDenied"):
+				raise
+			print("BatchGetSecretValue is not allowed, falling back to get_secret_value:", e)
+			secrets = {}
+	if not batched:
+		if secret_names is None:
+			secret_names = [secret["Name"] for secret in iter_secrets(client, region_name, name_prefix, tags)]
+
+		def fetch(name):
+			return name, secret_value(client.get_secret_value(SecretId=name))
+
+		with ThreadPoolExecutor(max_workers=max_workers) as executor:
+			futures = [executor.submit(fetch, name) for name in secret_names]
+			for future in futures:
+				try:
+					name, value = future.result()
+					secrets[name] = value
+				except ClientError as e:
+					print("A secret could not be retrieved:", e)
+	if cache is None:
+		cache = SECRET_CACHE
+	if cache is not False:
+		for name, value in secrets.items():
+			cache.put(name, value, region_name=region_name)
+	return secrets
 
 
 def update_secret(
@@ -85,6 +339,8 @@ def update_secret(
 	# secret_name = "MySecretName"
 	# region_name = "us-west-2"
 	if client is None:
-		client = new_session(region_name=region_name)
+		client = get_client(region_name=region_name)
 
-		return client.update_secret(SecretId=secret_name, **kwargs)
+	response = client.update_secret(SecretId=secret_name, **kwargs)
+	SECRET_CACHE.invalidate(secret_name)
+	return response
@@ -1,14 +1,55 @@
 
 import boto3
 import os
+import asyncio
+import json
+import logging
+import queue
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 
 from yaml import safe_load
+try:
+	import orjson
+except ImportError:
+	orjson = None
+try:
+	from aiobotocore.session import get_session
+except ImportError:
+	get_session = None
 
-# logger = logging.getLogger(__name__)
+# delete_message_batch, change_message_visibility_batch and send_message_batch take at most 10 entries
+BATCH_SIZE = 10
+# total payload of a message or a whole batch
+MAX_PAYLOAD_SIZE = 256 * 1024
+# body of a message offloaded to S3, compatible with the AWS extended client libraries
+S3_POINTER_CLASS = 'software.amazon.payloadoffloading.PayloadS3Pointer'
+
+logger = logging.getLogger(__name__)
 name = os.path.basename(__file__).split(".")[0]
 os.environ['AWS_DEFAULT_REGION'] = 'us-west-2'
 os.environ['AWS_REGION'] = 'us-west-2'
 
+def json_loads(text):
+	if orjson is not None:
+		return orjson.loads(text)
+	return json.loads(text)
+
+def decode(text):
+	'''
+	JSON first, YAML only for text that is not JSON
+	'''
+	stripped = text.lstrip()
+	if stripped[:1] in ('{','[','"') or stripped[:1].isdigit() or stripped[:1] == '-':
+		try:
+			return json_loads(stripped)
+		except ValueError:
+			pass
+	return safe_load(text)
+
 class SQSQueue():
 	'''
 	S3.Resource
@@ -28,8 +69,16 @@ class SQSQueue():
 			# queue_url = response['QueueUrl']
 			queue_url = creds['sqsReportsURL']
 		self.queue = self.resource.Queue(queue_url)
-		self.queue.load()
-		self.message_count = self.queue.attributes['ApproximateNumberOfMessages']
+		self.refresh_counts()
+	def refresh_counts(self,sqs_queue=None):
+		'''
+		Reload the queue attributes and update message_count
+		'''
+		sqs_queue = sqs_queue or self.queue
+		sqs_queue.load()
+		self.message_count = int(sqs_queue.attributes['ApproximateNumberOfMessages'])
+		self.in_flight_count = int(sqs_queue.attributes.get('ApproximateNumberOfMessagesNotVisible',0))
+		return self.message_count
 	def poll(self,**kwargs):
 		if kwargs.get('WaitTimeSeconds',0) < 1:
 			kwargs['WaitTimeSeconds'] = 20
@@ -37,18 +86,116 @@ class SQSQueue():
 			kwargs['MaxNumberOfMessages'] = 10
 		return self.queue.receive_messages(**kwargs)
 	def load_messages(self,messages=[],load_all=False):
+		'''
+		One poll (or messages) as Message, with load_all every message until the queue is drained, see stream
+		'''
+		if load_all:
+			yield from self.stream()
+			return
 		if not messages:
 			messages = self.poll()
-		self.queue.load()
 		for m in messages:
 			yield Message(m)
-		if load_all:
-			message_count = len(messages)
-			while message_count < self.message_count:
-				messages = self.poll()
-				yield from self.load_messages(messages=messages)
-				message_count += len(messages)
-				
+	def stream(self,prefetch=50,max_empty_receives=2,refresh_interval=30,decoder=decode,**poll_kwargs):
+		'''
+		Yield Message until the queue is drained
+		A background thread long polls into a buffer of at most prefetch messages, so receiving overlaps with handling.
+		After max_empty_receives empty receives in a row the attribute counts are refreshed and the stream ends
+		when ApproximateNumberOfMessages is 0, counts are also refreshed every refresh_interval seconds.
+		Messages still buffered when the generator is closed are made visible again.
+		'''
+		buffer = queue.Queue(maxsize=max(prefetch,1))
+		stop = threading.Event()
+		done = object()
+		poll_kwargs.setdefault('WaitTimeSeconds',20)
+		poll_kwargs.setdefault('MaxNumberOfMessages',10)
+
+		def release(messages):
+			for m in messages:
+				try:
+					m.change_visibility(VisibilityTimeout=0)
+				except Exception as e:
+					logger.error(f'could not release message {m.message_id}: {e}')
+
+		def put(item):
+			while not stop.is_set():
+				try:
+					buffer.put(item,timeout=0.1)
+					return True
+				except queue.Full:
+					continue
+			return False
+
+		def receive():
+			sqs_queue = self.thread_queue()
+			empty_receives = 0
+			last_refresh = time.monotonic()
+			try:
+				while not stop.is_set():
+					messages = sqs_queue.receive_messages(**poll_kwargs)
+					if time.monotonic() - last_refresh >= refresh_interval:
+						self.refresh_counts(sqs_queue)
+						last_refresh = time.monotonic()
+					if not messages:
+						empty_receives += 1
+						if empty_receives >= max_empty_receives:
+							last_refresh = time.monotonic()
+							if self.refresh_counts(sqs_queue) == 0:
+								break
+							empty_receives = 0
+						continue
+					empty_receives = 0
+					for n,m in enumerate(messages):
+						if not put(m):
+							release(messages[n:])
+							return
+			except Exception as e:
+				put(e)
+			finally:
+				put(done)
+
+		thread = threading.Thread(target=receive,name='sqs-stream',daemon=True)
+		thread.start()
+		try:
+			while True:
+				item = buffer.get()
+				if item is done:
+					break
+				if isinstance(item,Exception):
+					raise item
+				yield Message(item,decoder)
+		finally:
+			stop.set()
+			leftover = []
+			while True:
+				try:
+					item = buffer.get_nowait()
+				except queue.Empty:
+					break
+				if item is not done and not isinstance(item,Exception):
+					leftover.append(item)
+			release(leftover)
+	def thread_queue(self):
+		'''
+		sqs.Queue with its own session for use from another thread, resources are not thread safe
+		'''
+		return boto3.session.Session().resource('sqs').Queue(self.queue.url)
+	def ack_batcher(self,**kwargs):
+		'''
+		AckBatcher for messages of this queue, kwargs are passed to AckBatcher
+		'''
+		return AckBatcher(self,**kwargs)
+	def producer(self,**kwargs):
+		'''
+		Producer batching messages sent to this queue, kwargs are passed to Producer
+		'''
+		return Producer(self,**kwargs)
+	def consumer(self,handler,**kwargs):
+		'''
+		ConsumerPool running handler on messages of this queue, kwargs are passed to ConsumerPool
+		'''
+		return ConsumerPool(self,handler,**kwargs)
+
 	
 def load_credentials(cred_file = "amazon.properties"):
 	
@@ -65,18 +212,776 @@ def load_credentials(cred_file = "amazon.properties"):
 			prop_creds[temp_key] = val
 	return prop_creds
 
+# marks a field that has not been decoded yet
+UNDECODED = object()
+
 class Message():
-	def __init__(self,message):
+	'''
+	Received message with body and attributes decoded on first access by decoder (default decode)
+	'''
+	__slots__ = ('raw_message','decoder','_body','_attributes')
+	def __init__(self,message,decoder=decode):
 		self.raw_message = message
-		if isinstance(message.body,str):
-			self.body = safe_load(message.body)
-		elif isinstance(message.body,dict):
-			self.body = message.body
-		if isinstance(message.attributes,str):
-			self.attributes = safe_load(message.attributes)
-		elif isinstance(message.attributes,dict):
-			self.attributes = message.attributes
-	def delete(self):
+		self.decoder = decoder
+		self._body = UNDECODED
+		self._attributes = UNDECODED
+	def _decode(self,value):
+		if isinstance(value,(str,bytes)):
+			return self.decoder(value)
+		return value
+	@property
+	def body(self):
+		if self._body is UNDECODED:
+			self._body = self._decode(self.raw_message.body)
+		return self._body
+	@body.setter
+	def body(self,value):
+		self._body = value
+	@property
+	def attributes(self):
+		if self._attributes is UNDECODED:
+			self._attributes = self._decode(self.raw_message.attributes)
+		return self._attributes
+	@attributes.setter
+	def attributes(self,value):
+		self._attributes = value
+	def delete(self,ack_batcher=None):
+		'''
+		Delete now or queue the delete on an AckBatcher
+		'''
+		if ack_batcher is not None:
+			return ack_batcher.ack(self)
 		return self.raw_message.delete()
 
+def raw_message(message):
+	'''
+	boto3 sqs.Message from a Message or sqs.Message
+	'''
+	return getattr(message,'raw_message',message)
+
+class AckBatcher():
+	'''
+	Batches deletes and visibility extensions of received messages
+	ack(message) queues a delete that is sent with delete_message_batch once 10 are queued or the oldest is max_delay seconds old.
+	track(message) keeps a message in flight: every extend_interval seconds (default half of visibility_timeout)
+	all tracked messages get their visibility reset to visibility_timeout with change_message_visibility_batch,
+	so long running handlers are not redelivered. Entries that fail are retried up to max_retries times.
+	'''
+	def __init__(self,sqs_queue,max_delay=1.0,visibility_timeout=None,extend_interval=None,max_retries=3):
+		self.client = sqs_queue.queue.meta.client
+		self.queue_url = sqs_queue.queue.url
+		self.max_delay = max_delay
+		self.visibility_timeout = visibility_timeout
+		self.extend_interval = extend_interval or (visibility_timeout / 2 if visibility_timeout else None)
+		self.max_retries = max_retries
+		self.pending = []
+		self.pending_since = None
+		self.in_flight = {}
+		self.last_extend = time.monotonic()
+		self.lock = threading.Lock()
+		self.flush_lock = threading.Lock()
+		self.counts = {'acked':0,'delete_requests':0,'delete_failed':0,'extended':0,'extend_requests':0,'extend_failed':0}
+		self.closed = threading.Event()
+		self.thread = threading.Thread(target=self._run,name='sqs-ack-batcher',daemon=True)
+		self.thread.start()
+	def track(self,message):
+		message = raw_message(message)
+		with self.lock:
+			self.in_flight[message.message_id] = message.receipt_handle
+	def release(self,message,visible=False):
+		'''
+		Stop extending a message, with visible make it available to other consumers right away
+		'''
+		message = raw_message(message)
+		with self.lock:
+			self.in_flight.pop(message.message_id,None)
+		if visible:
+			message.change_visibility(VisibilityTimeout=0)
+	def ack(self,message):
+		message = raw_message(message)
+		with self.lock:
+			self.in_flight.pop(message.message_id,None)
+			self.pending.append((message.message_id,message.receipt_handle,0))
+			if self.pending_since is None:
+				self.pending_since = time.monotonic()
+			full = len(self.pending) >= BATCH_SIZE
+		if full:
+			self.flush(full_batches_only=True)
+	def _send(self,operation,entries,extra=None):
+		'''
+		Send entries (message_id, receipt_handle, attempts) in batches of 10, returns the entries that failed
+		'''
+		failed = []
+		for i in range(0,len(entries),BATCH_SIZE):
+			batch = entries[i:i + BATCH_SIZE]
+			request = [dict(extra or {},Id=str(n),ReceiptHandle=entry[1]) for n,entry in enumerate(batch)]
+			try:
+				response = operation(QueueUrl=self.queue_url,Entries=request)
+				failures = response.get('Failed',[])
+			except Exception as e:
+				logger.error(f'{operation.__name__} failed: {e}')
+				failures = [{'Id':entry['Id'],'Code':'RequestFailed','SenderFault':False} for entry in request]
+			for failure in failures:
+				entry = batch[int(failure['Id'])]
+				logger.warning(f"{operation.__name__} entry {entry[0]} failed: {failure.get('Code')} {failure.get('Message','')}")
+				# a bad receipt handle will never succeed
+				if not failure.get('SenderFault'):
+					failed.append(entry)
+		return failed
+	def flush(self,full_batches_only=False):
+		'''
+		Send queued deletes, with full_batches_only a partial batch is left queued
+		'''
+		with self.flush_lock:
+			with self.lock:
+				count = len(self.pending) - len(self.pending) % BATCH_SIZE if full_batches_only else len(self.pending)
+				entries,self.pending = self.pending[:count],self.pending[count:]
+				self.pending_since = time.monotonic() if self.pending else None
+			if not entries:
+				return
+			failed = self._send(self.client.delete_message_batch,entries)
+			with self.lock:
+				self.counts['acked'] += len(entries) - len(failed)
+				self.counts['delete_requests'] += -(-len(entries) // BATCH_SIZE)
+				retry = [(m,r,attempts + 1) for m,r,attempts in failed if attempts < self.max_retries]
+				self.counts['delete_failed'] += len(failed) - len(retry)
+				self.pending.extend(retry)
+				if self.pending and self.pending_since is None:
+					self.pending_since = time.monotonic()
+	def extend(self):
+		'''
+		Reset the visibility timeout of every tracked message
+		'''
+		with self.lock:
+			entries = [(m,r,0) for m,r in self.in_flight.items()]
+		self.last_extend = time.monotonic()
+		if not entries or not self.visibility_timeout:
+			return
+		failed = self._send(self.client.change_message_visibility_batch,entries,{'VisibilityTimeout':self.visibility_timeout})
+		with self.lock:
+			self.counts['extended'] += len(entries) - len(failed)
+			self.counts['extend_requests'] += -(-len(entries) // BATCH_SIZE)
+			self.counts['extend_failed'] += len(failed)
+	def _run(self):
+		while not self.closed.wait(0.1):
+			try:
+				with self.lock:
+					due = self.pending_since is not None and time.monotonic() - self.pending_since >= self.max_delay
+				if due:
+					self.flush()
+				if self.extend_interval and time.monotonic() - self.last_extend >= self.extend_interval:
+					self.extend()
+			except Exception as e:
+				logger.error(f'ack batcher: {e}')
+	def stats(self):
+		with self.lock:
+			stats = dict(self.counts)
+			stats['pending'] = len(self.pending)
+			stats['in_flight'] = len(self.in_flight)
+		return stats
+	def close(self):
+		self.closed.set()
+		self.thread.join()
+		self.flush()
+	def __enter__(self):
+		return self
+	def __exit__(self,*exc):
+		self.close()
+
+def attribute_size(attributes):
+	'''
+	Bytes message attributes count against the payload limit
+	'''
+	size = 0
+	for name,attribute in (attributes or {}).items():
+		size += len(name.encode()) + len(attribute['DataType'].encode())
+		if 'StringValue' in attribute:
+			size += len(attribute['StringValue'].encode())
+		else:
+			size += len(attribute.get('BinaryValue',b''))
+	return size
+
+class Producer():
+	'''
+	Buffers messages and sends them with send_message_batch
+	Batches are packed up to 10 entries and MAX_PAYLOAD_SIZE bytes and sent once full or max_delay seconds after the first message,
+	max_in_flight batches are sent concurrently and send blocks while they are all busy.
+	A batch holding a MessageGroupId waits for the previous batch of that group, retries included, so FIFO order
+	is kept across batches. Within a batch SQS may accept entries after one that failed, so a partial batch failure
+	can still reorder that group.
+	Only the entries that failed are retried, with jittered backoff. Messages larger than MAX_PAYLOAD_SIZE are uploaded
+	to s3_bucket through s3 (an S3Handler) when given and replaced by an extended client compatible pointer.
+	send returns a Future resolving to the MessageId.
+	'''
+	def __init__(self,sqs_queue,max_delay=0.05,max_in_flight=8,max_retries=5,s3=None,s3_bucket=None,s3_prefix='sqs-payloads/'):
+		self.client = sqs_queue.queue.meta.client
+		self.queue_url = sqs_queue.queue.url
+		self.max_delay = max_delay
+		self.max_retries = max_retries
+		self.s3 = s3
+		self.s3_bucket = s3_bucket
+		self.s3_prefix = s3_prefix
+		self.pending = []
+		self.pending_size = 0
+		self.pending_since = None
+		self.lock = threading.Lock()
+		# senders only take counts_lock, self.lock is held while waiting for a free slot
+		self.counts_lock = threading.Lock()
+		self.slots = threading.BoundedSemaphore(max_in_flight)
+		self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+		self.futures = set()
+		# MessageGroupId: future of the last batch holding that group
+		self.group_tails = {}
+		self.counts = {'sent':0,'failed':0,'batches':0,'retries':0,'offloaded':0}
+		self.closed = threading.Event()
+		self.thread = threading.Thread(target=self._run,name='sqs-producer',daemon=True)
+		self.thread.start()
+	def _offload(self,body,attributes):
+		if self.s3 is None or not self.s3_bucket:
+			raise ValueError(f'message of {len(body.encode())} bytes exceeds {MAX_PAYLOAD_SIZE} bytes and no S3 bucket is configured')
+		key = f'{self.s3_prefix}{uuid.uuid4()}'
+		self.s3.put_object(Bucket=self.s3_bucket,Key=key,Body=body.encode())
+		attributes = dict(attributes or {})
+		attributes['ExtendedPayloadSize'] = {'DataType':'Number','StringValue':str(len(body.encode()))}
+		with self.counts_lock:
+			self.counts['offloaded'] += 1
+		return json.dumps([S3_POINTER_CLASS,{'s3BucketName':self.s3_bucket,'s3Key':key}]),attributes
+	def send(self,body,attributes=None,delay_seconds=None,group_id=None,deduplication_id=None):
+		'''
+		Queue a message, body may be a str or JSON serialisable, attributes are SQS MessageAttributes
+		'''
+		if not isinstance(body,str):
+			body = json.dumps(body)
+		size = len(body.encode()) + attribute_size(attributes)
+		if size > MAX_PAYLOAD_SIZE:
+			body,attributes = self._offload(body,attributes)
+			size = len(body.encode()) + attribute_size(attributes)
+		entry = {'MessageBody':body}
+		if attributes:
+			entry['MessageAttributes'] = attributes
+		if delay_seconds is not None:
+			entry['DelaySeconds'] = delay_seconds
+		if group_id is not None:
+			entry['MessageGroupId'] = group_id
+		if deduplication_id is not None:
+			entry['MessageDeduplicationId'] = deduplication_id
+		future = Future()
+		with self.lock:
+			if self.pending and self.pending_size + size > MAX_PAYLOAD_SIZE:
+				self._dispatch_locked()
+			self.pending.append((entry,size,future))
+			self.pending_size += size
+			if self.pending_since is None:
+				self.pending_since = time.monotonic()
+			if len(self.pending) >= BATCH_SIZE:
+				self._dispatch_locked()
+		return future
+	def _dispatch_locked(self):
+		'''
+		Hand the pending batch to the executor, caller holds self.lock
+		'''
+		batch = self.pending
+		self.pending = []
+		self.pending_size = 0
+		self.pending_since = None
+		groups = {entry['MessageGroupId'] for entry,_,_ in batch if 'MessageGroupId' in entry}
+		# backpressure: wait for a free in-flight slot
+		self.slots.acquire()
+		with self.counts_lock:
+			previous = {self.group_tails[group] for group in groups if group in self.group_tails}
+			# earlier batches were submitted first, so they are running or done by the time this one waits on them
+			future = self.executor.submit(self._send_batch,batch,previous)
+			for group in groups:
+				self.group_tails[group] = future
+		self.futures.add(future)
+		future.add_done_callback(self.futures.discard)
+		if groups:
+			future.add_done_callback(lambda done: self._release_groups(done,groups))
+	def _release_groups(self,future,groups):
+		with self.counts_lock:
+			for group in groups:
+				if self.group_tails.get(group) is future:
+					del self.group_tails[group]
+	def _send_batch(self,batch,previous=()):
+		try:
+			if previous:
+				wait(previous)
+			attempt = 0
+			while batch:
+				entries = []
+				for n,(entry,_,_) in enumerate(batch):
+					entries.append(dict(entry,Id=str(n)))
+				try:
+					response = self.client.send_message_batch(QueueUrl=self.queue_url,Entries=entries)
+				except Exception as e:
+					logger.error(f'send_message_batch failed: {e}')
+					response = {'Failed':[{'Id':entry['Id'],'Code':'RequestFailed','SenderFault':False,'Message':str(e)} for entry in entries]}
+				with self.counts_lock:
+					self.counts['batches'] += 1
+				for success in response.get('Successful',[]):
+					batch[int(success['Id'])][2].set_result(success['MessageId'])
+					with self.counts_lock:
+						self.counts['sent'] += 1
+				retry = []
+				for failure in response.get('Failed',[]):
+					entry = batch[int(failure['Id'])]
+					if failure.get('SenderFault') or attempt >= self.max_retries:
+						entry[2].set_exception(RuntimeError(f"send_message_batch entry failed: {failure.get('Code')} {failure.get('Message','')}"))
+						with self.counts_lock:
+							self.counts['failed'] += 1
+					else:
+						retry.append(entry)
+				batch = retry
+				if batch:
+					time.sleep(random.uniform(0,min(5,0.05 * 2 ** attempt)))
+					attempt += 1
+					with self.counts_lock:
+						self.counts['retries'] += len(batch)
+		finally:
+			self.slots.release()
+	def _run(self):
+		while not self.closed.wait(min(self.max_delay,0.05)):
+			with self.lock:
+				if self.pending_since is not None and time.monotonic() - self.pending_since >= self.max_delay:
+					self._dispatch_locked()
+	def flush(self):
+		'''
+		Send everything queued and wait for every batch in flight
+		'''
+		with self.lock:
+			if self.pending:
+				self._dispatch_locked()
+			futures = list(self.futures)
+		for future in futures:
+			future.result()
+	def stats(self):
+		with self.counts_lock:
+			stats = dict(self.counts)
+		stats['pending'] = len(self.pending)
+		return stats
+	def close(self):
+		self.closed.set()
+		self.thread.join()
+		self.flush()
+		self.executor.shutdown(wait=True)
+	def __enter__(self):
+		return self
+	def __exit__(self,*exc):
+		self.close()
+
+def process_message(handler,body,attributes):
+	'''
+	Runs in a worker process, handler gets the decoded body and attributes
+	'''
+	return handler(body,attributes)
+
+class ConsumerPool():
+	'''
+	Parallel long-poll consumer
+	pollers threads receive messages into a bounded work queue that workers handle with handler(Message).
+	Pollers only ask for as many messages as there are free slots in max_pending, so a slow handler stops polling
+	instead of letting received messages time out. Handled messages are deleted, messages whose handler raised are left
+	to be redelivered. With use_processes handlers run in a process pool as handler(body, attributes) and must be picklable.
+	With batch_acks deletes go through an AckBatcher that also extends the visibility of received messages to visibility_timeout.
+	stop(drain=True) stops polling and finishes everything already received.
+	'''
+	def __init__(self,sqs_queue,handler,pollers=2,workers=8,max_pending=None,use_processes=False,delete_on_success=True,
+			batch_acks=False,visibility_timeout=None,**poll_kwargs):
+		self.sqs_queue = sqs_queue
+		self.handler = handler
+		self.pollers = pollers
+		self.workers = workers
+		self.max_pending = max_pending or workers * 2
+		self.use_processes = use_processes
+		self.delete_on_success = delete_on_success
+		self.poll_kwargs = poll_kwargs
+		self.batch_acks = batch_acks
+		self.visibility_timeout = visibility_timeout
+		self.acks = None
+		self.work = queue.Queue()
+		self.slots = threading.Semaphore(self.max_pending)
+		self.stopping = threading.Event()
+		self.polled = threading.Event()
+		self.poller_threads = []
+		self.worker_threads = []
+		self.executor = None
+		self.lock = threading.Lock()
+		self.poll_stats = {'receives':0,'empty_receives':0,'received':0}
+		self.worker_stats = {}
+		self.start_time = None
+	def start(self):
+		self.start_time = time.monotonic()
+		if self.use_processes:
+			self.executor = ProcessPoolExecutor(max_workers=self.workers)
+		if self.batch_acks:
+			self.acks = AckBatcher(self.sqs_queue,visibility_timeout=self.visibility_timeout)
+		for i in range(self.pollers):
+			self.poller_threads.append(threading.Thread(target=self._poll,name=f'sqs-poller-{i}',daemon=True))
+		for i in range(self.workers):
+			self.worker_stats[i] = {'processed':0,'failed':0,'busy_seconds':0.0}
+			self.worker_threads.append(threading.Thread(target=self._work,args=(i,),name=f'sqs-worker-{i}',daemon=True))
+		for thread in self.poller_threads + self.worker_threads:
+			thread.start()
+		return self
+	def _acquire_slots(self,wanted):
+		'''
+		Block for one slot then take up to wanted without blocking
+		'''
+		while not self.stopping.is_set():
+			if self.slots.acquire(timeout=0.5):
+				break
+		else:
+			return 0
+		taken = 1
+		while taken < wanted and self.slots.acquire(blocking=False):
+			taken += 1
+		return taken
+	def _poll(self):
+		sqs_queue = self.sqs_queue.thread_queue()
+		while not self.stopping.is_set():
+			taken = self._acquire_slots(self.poll_kwargs.get('MaxNumberOfMessages',10))
+			if not taken:
+				break
+			kwargs = dict(self.poll_kwargs,MaxNumberOfMessages=taken)
+			kwargs.setdefault('WaitTimeSeconds',20)
+			try:
+				messages = sqs_queue.receive_messages(**kwargs)
+			except Exception as e:
+				logger.error(f'receive_messages failed: {e}')
+				messages = []
+				time.sleep(1)
+			with self.lock:
+				self.poll_stats['receives'] += 1
+				self.poll_stats['received'] += len(messages)
+				if not messages:
+					self.poll_stats['empty_receives'] += 1
+			for _ in range(taken - len(messages)):
+				self.slots.release()
+			for m in messages:
+				if self.acks is not None:
+					self.acks.track(m)
+				self.work.put(m)
+	def _handle(self,raw_message):
+		message = Message(raw_message)
+		if self.executor is not None:
+			return self.executor.submit(process_message,self.handler,message.body,message.attributes).result()
+		return self.handler(message)
+	def _work(self,index):
+		stats = self.worker_stats[index]
+		while True:
+			try:
+				raw_message = self.work.get(timeout=0.5)
+			except queue.Empty:
+				# pollers have stopped so nothing else will arrive
+				if self.polled.is_set():
+					return
+				continue
+			start = time.monotonic()
+			try:
+				self._handle(raw_message)
+				if not self.delete_on_success:
+					self._release(raw_message)
+				elif self.acks is not None:
+					self.acks.ack(raw_message)
+				else:
+					raw_message.delete()
+				stats['processed'] += 1
+			except Exception as e:
+				self._release(raw_message)
+				stats['failed'] += 1
+				logger.error(f'handler failed for message {raw_message.message_id}: {e}')
+			finally:
+				stats['busy_seconds'] += time.monotonic() - start
+				self.work.task_done()
+				self.slots.release()
+	def _release(self,raw_message,visible=False):
+		if self.acks is not None:
+			self.acks.release(raw_message,visible)
+		elif visible:
+			raw_message.change_visibility(VisibilityTimeout=0)
+	def stop(self,drain=True,timeout=None):
+		'''
+		Stop polling, with drain finish the received messages otherwise make them visible again right away
+		'''
+		self.stopping.set()
+		deadline = None if timeout is None else time.monotonic() + timeout
+		remaining = lambda: None if deadline is None else max(deadline - time.monotonic(),0)
+		# a poller in a long poll returns within WaitTimeSeconds
+		for thread in self.poller_threads:
+			thread.join(remaining())
+		if not drain:
+			while True:
+				try:
+					raw_message = self.work.get_nowait()
+				except queue.Empty:
+					break
+				try:
+					self._release(raw_message,visible=True)
+				except Exception as e:
+					logger.error(f'could not release message {raw_message.message_id}: {e}')
+				self.work.task_done()
+				self.slots.release()
+		self.polled.set()
+		for thread in self.worker_threads:
+			thread.join(remaining())
+		if self.executor is not None:
+			self.executor.shutdown(wait=True)
+		if self.acks is not None:
+			self.acks.close()
+		logger.info(f'consumer stopped: {self.stats()}')
+	def wait(self):
+		'''
+		Block until stop is called, KeyboardInterrupt stops with drain
+		'''
+		try:
+			while not self.stopping.wait(1):
+				pass
+		except KeyboardInterrupt:
+			self.stop()
+	def stats(self):
+		elapsed = time.monotonic() - self.start_time if self.start_time else 0.0
+		with self.lock:
+			stats = dict(self.poll_stats)
+		stats['pending'] = self.work.qsize()
+		stats['workers'] = {}
+		for index,worker in self.worker_stats.items():
+			worker = dict(worker)
+			worker['messages_per_second'] = worker['processed'] / elapsed if elapsed else 0.0
+			stats['workers'][index] = worker
+		stats['processed'] = sum(w['processed'] for w in stats['workers'].values())
+		if self.acks is not None:
+			stats['acks'] = self.acks.stats()
+		stats['messages_per_second'] = stats['processed'] / elapsed if elapsed else 0.0
+		return stats
+	def __enter__(self):
+		return self.start()
+	def __exit__(self,*exc):
+		self.stop()
+
+class ReceivedMessage():
+	'''
+	receive_message response entry with the attributes Message reads from a boto3 sqs.Message
+	delete() queues the delete on the AsyncSQSQueue it was received from, await the returned future
+	'''
+	__slots__ = ('message_id','receipt_handle','body','attributes','message_attributes','queue')
+	def __init__(self,entry,queue):
+		self.message_id = entry['MessageId']
+		self.receipt_handle = entry['ReceiptHandle']
+		self.body = entry.get('Body')
+		self.attributes = entry.get('Attributes',{})
+		self.message_attributes = entry.get('MessageAttributes',{})
+		self.queue = queue
+	def delete(self):
+		return self.queue.ack(self)
+
+class AsyncSQSQueue():
+	'''
+	asyncio consumer and producer for one queue built on aiobotocore
+	messages() runs concurrent long polls and yields Message, ack() and send() are batched into 10 entry
+	delete_message_batch and send_message_batch calls flushed when full or max_delay seconds after the first entry.
+	close() stops polling, makes buffered messages visible again and flushes pending acks and sends even when cancelled.
+	'''
+	def __init__(self,queue_url,max_delay=0.05,max_retries=5,region_name=None,decoder=decode):
+		if get_session is None:
+			raise ImportError('AsyncSQSQueue requires aiobotocore')
+		self.queue_url = queue_url
+		self.max_delay = max_delay
+		self.max_retries = max_retries
+		self.region_name = region_name or os.environ.get('AWS_REGION')
+		self.decoder = decoder
+		self.client = None
+		self.client_context = None
+		self.acks = []
+		self.sends = []
+		self.sends_size = 0
+		self.flusher = None
+		self.batches = set()
+	async def open(self):
+		self.client_context = get_session().create_client('sqs',region_name=self.region_name)
+		self.client = await self.client_context.__aenter__()
+		self.flusher = asyncio.create_task(self._flush_periodically())
+		return self
+	async def close(self):
+		if self.flusher is not None:
+			self.flusher.cancel()
+			await asyncio.gather(self.flusher,return_exceptions=True)
+			self.flusher = None
+		# finish pending work even if the caller is being cancelled
+		await asyncio.shield(self.flush())
+		await self.client_context.__aexit__(None,None,None)
+		self.client = None
+	async def __aenter__(self):
+		return await self.open()
+	async def __aexit__(self,*exc):
+		await self.close()
+	async def receive(self,**kwargs):
+		kwargs.setdefault('WaitTimeSeconds',20)
+		kwargs.setdefault('MaxNumberOfMessages',10)
+		response = await self.client.receive_message(QueueUrl=self.queue_url,**kwargs)
+		return [Message(ReceivedMessage(entry,self),self.decoder) for entry in response.get('Messages',[])]
+	async def messages(self,pollers=4,prefetch=100,**kwargs):
+		'''
+		Yield Message from pollers concurrent long polls through a buffer of prefetch messages
+		'''
+		buffer = asyncio.Queue(maxsize=prefetch)
+		# received by a poller cancelled before it could buffer them
+		unbuffered = []
+
+		async def poll():
+			while True:
+				try:
+					messages = await self.receive(**kwargs)
+				except asyncio.CancelledError:
+					raise
+				except Exception as e:
+					logger.error(f'receive_message failed: {e}')
+					await asyncio.sleep(1)
+					continue
+				for i,m in enumerate(messages):
+					try:
+						await buffer.put(m)
+					except asyncio.CancelledError:
+						unbuffered.extend(messages[i:])
+						raise
+
+		tasks = [asyncio.create_task(poll()) for _ in range(pollers)]
+		try:
+			while True:
+				yield await buffer.get()
+		finally:
+			for task in tasks:
+				task.cancel()
+			await asyncio.gather(*tasks,return_exceptions=True)
+			leftover = unbuffered
+			while not buffer.empty():
+				leftover.append(buffer.get_nowait())
+			if leftover:
+				await asyncio.shield(self.release(leftover))
+	async def release(self,messages):
+		'''
+		Make messages visible to other consumers right away
+		'''
+		for i in range(0,len(messages),BATCH_SIZE):
+			entries = [
+				{'Id':str(n),'ReceiptHandle':raw_message(m).receipt_handle,'VisibilityTimeout':0}
+				for n,m in enumerate(messages[i:i + BATCH_SIZE])
+			]
+			try:
+				await self.client.change_message_visibility_batch(QueueUrl=self.queue_url,Entries=entries)
+			except Exception as e:
+				logger.error(f'change_message_visibility_batch failed: {e}')
+	async def consume(self,handler,pollers=4,concurrency=100,**kwargs):
+		'''
+		Run the coroutine handler(Message) on up to concurrency messages at once and ack those it returns from
+		Runs until cancelled, handlers already started are awaited before returning.
+		'''
+		slots = asyncio.Semaphore(concurrency)
+		running = set()
+
+		async def run(message):
+			try:
+				await handler(message)
+				await self.ack(message)
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				logger.error(f'handler failed for message {raw_message(message).message_id}: {e}')
+			finally:
+				slots.release()
 
+		try:
+			async for message in self.messages(pollers,max(concurrency,BATCH_SIZE),**kwargs):
+				await slots.acquire()
+				task = asyncio.create_task(run(message))
+				running.add(task)
+				task.add_done_callback(running.discard)
+		finally:
+			if running:
+				await asyncio.shield(asyncio.gather(*running,return_exceptions=True))
+	def ack(self,message):
+		'''
+		Queue a delete, the returned future is done once it was sent
+		'''
+		future = asyncio.get_running_loop().create_future()
+		self.acks.append((raw_message(message).receipt_handle,future))
+		if len(self.acks) >= BATCH_SIZE:
+			self._start(self._delete_batch(self._take_acks()))
+		return future
+	def send(self,body,attributes=None,**kwargs):
+		'''
+		Queue a message, the returned future resolves to its MessageId
+		kwargs are extra send_message_batch entry fields (DelaySeconds, MessageGroupId...)
+		'''
+		if not isinstance(body,str):
+			body = json.dumps(body)
+		size = len(body.encode()) + attribute_size(attributes)
+		if size > MAX_PAYLOAD_SIZE:
+			raise ValueError(f'message of {size} bytes exceeds {MAX_PAYLOAD_SIZE} bytes')
+		entry = dict(kwargs,MessageBody=body)
+		if attributes:
+			entry['MessageAttributes'] = attributes
+		if self.sends and self.sends_size + size > MAX_PAYLOAD_SIZE:
+			self._start(self._send_batch(self._take_sends()))
+		future = asyncio.get_running_loop().create_future()
+		self.sends.append((entry,future))
+		self.sends_size += size
+		if len(self.sends) >= BATCH_SIZE:
+			self._start(self._send_batch(self._take_sends()))
+		return future
+	def _take_acks(self):
+		acks,self.acks = self.acks[:BATCH_SIZE],self.acks[BATCH_SIZE:]
+		return acks
+	def _take_sends(self):
+		sends,self.sends = self.sends,[]
+		self.sends_size = 0
+		return sends
+	def _start(self,coroutine):
+		task = asyncio.create_task(coroutine)
+		self.batches.add(task)
+		task.add_done_callback(self.batches.discard)
+	async def _call_batch(self,operation,batch):
+		'''
+		Call a batch operation with entries [(entry, future)], retrying failed entries that are not sender faults
+		'''
+		for attempt in range(self.max_retries + 1):
+			entries = [dict(entry,Id=str(n)) for n,(entry,_) in enumerate(batch)]
+			try:
+				response = await operation(QueueUrl=self.queue_url,Entries=entries)
+			except Exception as e:
+				response = {'Failed':[{'Id':entry['Id'],'Code':'RequestFailed','SenderFault':False,'Message':str(e)} for entry in entries]}
+			for success in response.get('Successful',[]):
+				future = batch[int(success['Id'])][1]
+				if not future.done():
+					future.set_result(success.get('MessageId',success['Id']))
+			retry = []
+			for failure in response.get('Failed',[]):
+				entry,future = batch[int(failure['Id'])]
+				if failure.get('SenderFault') or attempt == self.max_retries:
+					if not future.done():
+						future.set_exception(RuntimeError(f"{failure.get('Code')} {failure.get('Message','')}"))
+				else:
+					retry.append((entry,future))
+			batch = retry
+			if not batch:
+				return
+			await asyncio.sleep(random.uniform(0,min(5,0.05 * 2 ** attempt)))
+	async def _delete_batch(self,acks):
+		await self._call_batch(self.client.delete_message_batch,[({'ReceiptHandle':handle},future) for handle,future in acks])
+	async def _send_batch(self,sends):
+		await self._call_batch(self.client.send_message_batch,sends)
+	async def flush(self):
+		'''
+		Send every queued ack and message and wait for all batches in flight
+		'''
+		self._dispatch()
+		if self.batches:
+			await asyncio.gather(*list(self.batches),return_exceptions=True)
+	def _dispatch(self):
+		while self.acks:
+			self._start(self._delete_batch(self._take_acks()))
+		if self.sends:
+			self._start(self._send_batch(self._take_sends()))
+	async def _flush_periodically(self):
+		while True:
+			await asyncio.sleep(self.max_delay)
+			self._dispatch()